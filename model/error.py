@@ -0,0 +1,142 @@
+"""Contains the error classification for OpenAI completions."""
+
+import asyncio
+from typing import Literal, Mapping
+
+import httpx
+import openai
+
+ErrorKind = Literal[
+    "rate_limit",       # 429, retryable
+    "quota",            # 429 insufficient_quota, terminal
+    "server",           # 5xx, retryable
+    "timeout",          # request timed out, retryable
+    "connection",       # connection reset or refused, retryable
+    "auth",             # 401 and 403, terminal
+    "not_found",        # 404, e.g. unknown model, terminal
+    "context_length",   # prompt plus max_tokens too long, terminal
+    "content_filter",   # rejected by the content policy, terminal
+    "invalid_request",  # any other 4xx validation error, terminal
+    "unknown",          # anything else, terminal
+]
+
+RETRYABLE_KINDS = {"rate_limit", "server", "timeout", "connection"}
+
+class CompletionError(Exception):
+    """
+    Classified failure of an OpenAI completion.
+
+    Attributes
+    ----------
+    kind : ErrorKind
+        the category of the failure
+    status : int
+        the HTTP status code, if the API responded
+    retryable : bool
+        whether retrying the same request can succeed
+    headers : Mapping[str, str]
+        the response headers, if the API responded
+    cause : Exception
+        the original exception
+    """
+    kind: ErrorKind
+    status: int = None
+    retryable: bool
+    headers: Mapping[str, str] = None
+    cause: Exception
+
+    def __init__(self, kind: ErrorKind, cause: Exception, status: int = None, headers: Mapping[str, str] = None) -> None:
+        """
+        Initialize the CompletionError.
+
+        Parameters
+        ----------
+        kind : ErrorKind
+            the category of the failure
+        cause : Exception
+            the original exception
+        status : int
+            the HTTP status code, if the API responded
+        headers : Mapping[str, str]
+            the response headers, if the API responded
+        """
+        super().__init__(str(cause))
+        self.kind = kind
+        self.cause = cause
+        self.status = status
+        self.headers = headers
+        self.retryable = kind in RETRYABLE_KINDS
+
+    def __str__(self) -> str:
+        status = f" ({self.status})" if self.status else ""
+        return f"{self.kind}{status}: {self.cause}"
+
+def classify_status(status: int, code: str = None) -> ErrorKind:
+    """
+    Map an HTTP status and API error code to an error kind.
+
+    Parameters
+    ----------
+    status : int
+        the HTTP status code
+    code : str
+        the `code` field of the API error body
+
+    Returns
+    -------
+    ErrorKind
+        the error kind
+    """
+    code = code or ""
+
+    if status == 429:
+        return "quota" if code == "insufficient_quota" else "rate_limit"
+    elif status == 408:
+        return "timeout"
+    elif status >= 500 or status == 409:
+        return "server"
+    elif status in (401, 403):
+        return "auth"
+    elif status == 404:
+        return "not_found"
+    elif code == "context_length_exceeded":
+        return "context_length"
+    elif code in ("content_filter", "content_policy_violation"):
+        return "content_filter"
+    return "invalid_request"
+
+def classify_error(error: Exception) -> CompletionError:
+    """
+    Sort an exception into a retryable or terminal CompletionError.
+
+    Parameters
+    ----------
+    error : Exception
+        the exception raised by the OpenAI client
+
+    Returns
+    -------
+    CompletionError
+        the classified error
+    """
+    if isinstance(error, CompletionError):
+        return error
+
+    if isinstance(error, (openai.APITimeoutError, asyncio.TimeoutError, TimeoutError)):
+        return CompletionError("timeout", error)
+    if isinstance(error, (openai.APIConnectionError, ConnectionError)):
+        return CompletionError("connection", error)
+
+    # Errors while reading a stream come straight from httpx, or as an error event in the stream
+    if isinstance(error, httpx.TimeoutException):
+        return CompletionError("timeout", error)
+    if isinstance(error, httpx.TransportError):
+        return CompletionError("connection", error)
+    if isinstance(error, openai.APIError) and not isinstance(error, openai.APIStatusError):
+        return CompletionError("server", error)
+
+    if not isinstance(error, openai.APIStatusError):
+        return CompletionError("unknown", error)
+
+    kind = classify_status(error.status_code, error.code)
+    return CompletionError(kind, error, status=error.status_code, headers=error.response.headers)
@@ -1,15 +1,27 @@
 """Contains the OpenAI model class for running completions."""
 
 import openai
-from time import perf_counter
+import httpx
+import json
+from openai.types.chat import ChatCompletion
+from time import perf_counter, monotonic, sleep
 from pathlib import Path
-from typing import List, Dict, Literal, TypeVar
+from typing import List, Dict, Literal, Tuple, TypeVar, Union
 import traceback
 import asyncio
+from contextlib import nullcontext
 
 from message.message import UserMessage, SystemMessage, ModelMessage
+from model.error import CompletionError, classify_error, classify_status
+from model.stream import CompletionStream
 from util.log import Logger
 from util.image import encode_image
+from util.limiter import RateLimiter
+from util.concurrency import AdaptiveConcurrency
+from util.retry import RetryPolicy
+from util.cache import CompletionCache, MemoryCache, fingerprint
+from util.metrics import LatencyMetrics
+from util.tokens import estimate_tokens
 
 logger = Logger(__name__)
 
@@ -23,8 +35,12 @@ class OpenAI:
     ----------
     client : openai.OpenAI
         the OpenAI client
+    async_client : openai.AsyncOpenAI
+        the pooled async OpenAI client, created on first use
     api_key : str
         the API key for the OpenAI client
+    base_url : str
+        the API base URL, e.g. a local mock server
     model : str
         the model to use
     frequency_penalty : float
@@ -49,16 +65,51 @@ class OpenAI:
         the temperature
     top_p : float
         the top p value
+    calls_per_second : float
+        the maximum request rate
+    tokens_per_minute : int
+        the maximum token rate, prompt plus completion
+    limiter : RateLimiter
+        the rate limiter shared by every call on this instance
+    token_limiter : RateLimiter
+        the token budget shared by every call on this instance
+    max_connections : int
+        the maximum number of pooled connections
+    max_keepalive_connections : int
+        the maximum number of idle connections kept alive
+    keepalive_expiry : float
+        the seconds an idle connection is kept alive
+    concurrency : AdaptiveConcurrency
+        the AIMD controller for requests in flight, if adaptive
+    retry : RetryPolicy
+        the retry policy shared by run and arun
+    cache : CompletionCache
+        the persistent read-through completion cache, if any
+    memory_cache : MemoryCache
+        the in-memory LRU tier in front of the persistent cache, if any
+    in_flight : Dict[str, asyncio.Future]
+        the requests currently running in arun, keyed by fingerprint
+    stream : bool
+        whether run and arun stream the completion
+    stop_at_fence : bool
+        whether a streamed completion is cancelled once its first code block closes
+    metrics : LatencyMetrics
+        the queueing, time to first token, duration and speed of every request
         
     Example
     -------
     ```python
     from evaluation.models.openai import OpenAI
     openai = OpenAI(api_key)
+    
+    async with OpenAI(api_key) as openai:
+        response, completion = await openai.arun(messages)
     ```
     """
     client: openai.OpenAI
+    async_client: openai.AsyncOpenAI = None
     api_key: str
+    base_url: str = None
     model: str = "gpt-4-turbo"
     frequency_penalty: float = 0.0 # -2.0 to 2.0
     presence_penalty: float = 0.0 # -2.0 to 2.0
@@ -72,8 +123,22 @@ class OpenAI:
     temperature: float = 1.0 # 0.0 to 2.0
     top_p: float = 1.0 # 0.0 to 1.0
     calls_per_second: float = 5.0
+    tokens_per_minute: int = None
+    limiter: RateLimiter
+    token_limiter: RateLimiter = None
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 5.0
+    concurrency: AdaptiveConcurrency = None
+    retry: RetryPolicy
+    cache: CompletionCache = None
+    memory_cache: MemoryCache = None
+    in_flight: Dict[str, asyncio.Future]
+    stream: bool = False
+    stop_at_fence: bool = False
+    metrics: LatencyMetrics
     
-    def __init__(self, api_key: str, model: str = "gpt-4-turbo", frequency_penalty: float = 0.0, presence_penalty: float = 0.0, logit_bias: Dict[str, int] = None, logprobs: bool = False, top_logprobs: int = None, max_tokens: int = 1000, n: int = None, seed: int = None, stop: List[str] = None, temperature: float = 1.0, top_p: float = 1.0, calls_per_second: float = 5.0) -> None:
+    def __init__(self, api_key: str, model: str = "gpt-4-turbo", frequency_penalty: float = 0.0, presence_penalty: float = 0.0, logit_bias: Dict[str, int] = None, logprobs: bool = False, top_logprobs: int = None, max_tokens: int = 1000, n: int = None, seed: int = None, stop: List[str] = None, temperature: float = 1.0, top_p: float = 1.0, calls_per_second: float = 5.0, tokens_per_minute: int = None, max_connections: int = 100, max_keepalive_connections: int = 20, keepalive_expiry: float = 5.0, adaptive_concurrency: bool = False, retry: RetryPolicy = None, base_url: str = None, cache: Union[Path, CompletionCache] = None, memory_cache: MemoryCache = None, stream: bool = False, stop_at_fence: bool = False) -> None:
         """
         Initialize the OpenAI model.
         
@@ -103,10 +168,35 @@ class OpenAI:
             the temperature
         top_p : float
             the top p value
+        calls_per_second : float
+            the maximum request rate
+        tokens_per_minute : int
+            the maximum token rate, unlimited if None
+        max_connections : int
+            the maximum number of pooled connections
+        max_keepalive_connections : int
+            the maximum number of idle connections kept alive
+        keepalive_expiry : float
+            the seconds an idle connection is kept alive
+        adaptive_concurrency : bool
+            whether to adapt requests in flight to 429s and latency, up to max_connections
+        retry : RetryPolicy
+            the retry policy, defaults to `RetryPolicy()`
+        base_url : str
+            the API base URL, defaults to the OpenAI API
+        cache : Union[Path, CompletionCache]
+            the completion cache, or the path of its SQLite database
+        memory_cache : MemoryCache
+            the in-memory LRU tier checked before the persistent cache
+        stream : bool
+            whether run and arun stream the completion
+        stop_at_fence : bool
+            whether a streamed completion is cancelled once its first code block closes
         """
         self.api_key = api_key
+        self.base_url = base_url
         self.model = model
-        self.client = openai.OpenAI(api_key=api_key)
+        self.client = openai.OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
         self.frequency_penalty = frequency_penalty
         self.presence_penalty = presence_penalty
         self.logit_bias = logit_bias
@@ -119,8 +209,165 @@ class OpenAI:
         self.temperature = temperature
         self.top_p = top_p
         self.calls_per_second = calls_per_second
+        self.tokens_per_minute = tokens_per_minute
+        self.limiter = RateLimiter(calls_per_second)
+        self.token_limiter = RateLimiter(tokens_per_minute / 60, capacity=tokens_per_minute) if tokens_per_minute else None
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.concurrency = AdaptiveConcurrency(max_limit=max_connections) if adaptive_concurrency else None
+        self.retry = retry or RetryPolicy()
+        self.cache = CompletionCache(cache) if isinstance(cache, Path) else cache
+        self.memory_cache = memory_cache
+        self.in_flight = {}
+        self.stream = stream
+        self.stop_at_fence = stop_at_fence
+        self.metrics = LatencyMetrics()
+        
+    def get_async_client(self) -> openai.AsyncOpenAI:
+        """
+        Get the pooled async client, creating it on first use.
+        
+        The client is created lazily so it binds to the running event loop.
+        
+        Returns
+        -------
+        openai.AsyncOpenAI
+            the async OpenAI client
+        """
+        if self.async_client is None:
+            limits = httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            )
+            self.async_client = openai.AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                max_retries=0,
+                http_client=openai.DefaultAsyncHttpxClient(limits=limits),
+            )
+        return self.async_client
+    
+    async def aclose(self) -> None:
+        """
+        Close the pooled async client and its connections.
+        """
+        if self.async_client is not None:
+            await self.async_client.close()
+            self.async_client = None
+    
+    async def __aenter__(self) -> "OpenAI":
+        return self
+    
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+        
+    def cache_key(self, request: dict, trial: Union[int, Tuple[int, int]] = None) -> str:
+        """
+        Fingerprint a request for the completion cache.
+        
+        The key covers the messages, the model and every sampling parameter,
+        plus the trial index so repeated samples of one prompt stay distinct.
+        
+        Parameters
+        ----------
+        request : dict
+            the request built by `build_request`
+        trial : Union[int, Tuple[int, int]]
+            the trial index, or a (row, trial) pair to keep rows apart, if sampling the same request several times
+            
+        Returns
+        -------
+        str
+            the cache key
+        """
+        # Completions cut at the first code block differ from full ones
+        if self.stream and self.stop_at_fence:
+            return fingerprint({**request, "trial": trial, "stop_at_fence": True})
+        return fingerprint({**request, "trial": trial})
+    
+    def load_cached(self, key: str) -> ChatCompletion:
+        """
+        Load a completion from the memory tier, then the persistent tier.
         
-    def run(self, messages: List[Messages]) -> str:
+        Parameters
+        ----------
+        key : str
+            the cache key
+            
+        Returns
+        -------
+        ChatCompletion
+            the cached completion, or None on a miss
+        """
+        if self.memory_cache:
+            completion = self.memory_cache.get(key)
+            if completion is not None:
+                return completion
+        
+        value = self.cache.get(key) if self.cache else None
+        if value is None:
+            return None
+        logger.info(f"╰── Loaded OpenAI Completion {key[:12]} from cache.")
+        completion = ChatCompletion.model_validate_json(value)
+        
+        # Promote to the memory tier so the next lookup skips decoding
+        if self.memory_cache:
+            self.memory_cache.set(key, completion, size=len(value))
+        return completion
+    
+    def store_cached(self, key: str, completion: ChatCompletion) -> None:
+        """
+        Store a completion in every cache tier.
+        
+        Parameters
+        ----------
+        key : str
+            the cache key
+        completion : ChatCompletion
+            the completion to store
+        """
+        value = completion.model_dump_json()
+        if self.cache:
+            self.cache.set(key, value)
+        if self.memory_cache:
+            self.memory_cache.set(key, completion, size=len(value))
+        
+    def build_request(self, messages: List[dict], n: int = None) -> dict:
+        """
+        Build the chat completion request parameters.
+        
+        Parameters
+        ----------
+        messages : List[dict]
+            the messages in OpenAI API format
+        n : int
+            the number of choices to generate, defaults to the instance value
+            
+        Returns
+        -------
+        dict
+            the keyword arguments for `chat.completions.create`
+        """
+        request = dict(
+            messages=messages,
+            model=self.model,
+            frequency_penalty=self.frequency_penalty,
+            presence_penalty=self.presence_penalty,
+            max_tokens=self.max_tokens,
+            n=n if n is not None else self.n,
+            seed=self.seed,
+            temperature=self.temperature,
+            top_p=self.top_p
+        )
+        
+        # Only ask for logprobs when wanted, so existing cache keys stay valid
+        if self.logprobs:
+            request.update(logprobs=True, top_logprobs=self.top_logprobs)
+        return request
+        
+    def run(self, messages: List[Messages], trial: int = None) -> str:
         """
         Run the OpenAI completion.
         
@@ -128,6 +375,8 @@ class OpenAI:
         ----------
         messages : List[Messages]
             the messages to run the completion on
+        trial : int
+            the trial index, part of the cache key
             
         Returns
         -------
@@ -136,8 +385,8 @@ class OpenAI:
             
         Raises
         ------
-        Exception
-            if the completion fails
+        CompletionError
+            if the error is terminal or the retry budget is spent
         
         Example
         -------
@@ -155,32 +404,55 @@ class OpenAI:
         ```
         """
         
-        try:
+        messages = [message.to_openai() for message in messages]
+        request = self.build_request(messages)
+        requested = estimate_tokens(messages) + self.max_tokens * (request["n"] or 1)
+        started = monotonic()
+        
+        # Serve repeated requests from the cache
+        key = self.cache_key(request, trial) if self.cache or self.memory_cache else None
+        completion = self.load_cached(key) if key else None
+        if completion is not None:
+            return completion.choices[0].message.content
+        
+        for attempt in range(self.retry.max_attempts):
+        
+            try:
+                
+                # Admit the request against the token budget before sending
+                queued = perf_counter()
+                self.limiter.wait()
+                if self.token_limiter:
+                    self.token_limiter.wait(requested)
+                
+                logger.info(f"[A{attempt+1}] Running OpenAI Completion...")
+                logger.info(str(messages)[:200])
+                start = perf_counter()
             
-            messages = [message.to_openai() for message in messages]
-            
-            logger.info(f"Running OpenAI Completion...")
-            logger.info(str(messages)[:200])
-            start = perf_counter()
-        
-            completion = self.client.with_options(max_retries=5).chat.completions.create(
-                messages=messages,
-                model=self.model,
-                frequency_penalty=self.frequency_penalty,
-                presence_penalty=self.presence_penalty,
-                max_tokens=self.max_tokens,
-                seed=self.seed,
-                temperature=self.temperature,
-                top_p=self.top_p
-            )
+                client = self.client.with_options(timeout=self.retry.remaining(started))
+                if self.stream:
+                    completion, ttft = self.run_stream(client, request)
+                else:
+                    completion, ttft = client.chat.completions.create(**request), None
+                
+                end = perf_counter()
             
-            end = perf_counter()
-        
-        except Exception as e:
-            tb = traceback.format_exc()
-            #logger.error(f'{type(e).__name__} @ {__name__}: {e}\n{tb}')
-            logger.error(f"429 Resource Exhausted")
-            return
+            except Exception as e:
+                error = classify_error(e)
+                logger.error(f'[A{attempt+1}] {error}')
+                if self.token_limiter:
+                    self.token_limiter.adjust(requested)
+                
+                # Terminal errors can never succeed, so hand them straight back
+                if not error.retryable:
+                    raise error from e
+                delay = self.retry.delay(attempt, error.headers)
+                if not self.retry.should_retry(attempt, started, delay):
+                    raise error from e
+                sleep(delay)
+                continue
+            
+            break
         
         id = completion.id
         created = completion.created
@@ -195,44 +467,149 @@ class OpenAI:
         completion_tokens = completion.usage.completion_tokens
         total_tokens = completion.usage.total_tokens
         
+        self.metrics.record(end - start, queued=start - queued, ttft=ttft, tokens=completion_tokens)
+        
+        # Correct the budget with the real usage
+        if self.token_limiter:
+            self.token_limiter.adjust(requested - total_tokens)
+        
+        if key:
+            self.store_cached(key, completion)
+        
         logger.info(f"│\n         │\n{content}\n         │")
         logger.info(f"│   {created} {id} {fingerprint} {finish_reason} {prompt_tokens} {completion_tokens} {total_tokens}\n         │")
         logger.info(f"╰── Ran OpenAI Completion in {round(end - start, 2)} seconds.")
         
         return content
     
-    async def arun(self, messages: List[Messages]) -> str:
+    async def arun(self, messages: List[Messages], n: int = None, trial: Union[int, Tuple[int, int]] = None) -> str:
+        """
+        Run the OpenAI completion asynchronously.
+        
+        Concurrent identical requests with the same trial share one upstream
+        call. Pass a (row, trial) pair instead of the trial index when rows
+        with the same prompt must be sampled independently.
         
-        client = openai.AsyncOpenAI(api_key=self.api_key)
-        max_retries = 1000
+        Parameters
+        ----------
+        messages : List[Messages]
+            the messages to run the completion on
+        n : int
+            the number of choices to generate, defaults to the instance value
+        trial : Union[int, Tuple[int, int]]
+            the trial index, or a (row, trial) pair, part of the cache and coalescing key
+            
+        Returns
+        -------
+        Tuple[str, ChatCompletion]
+            the content of the first choice and the full completion
+            
+        Raises
+        ------
+        CompletionError
+            if the error is terminal or the retry budget is spent
+        """
         
         messages = [message.to_openai() for message in messages]
+        request = self.build_request(messages, n=n)
+        
+        # Identical requests are only interchangeable when the trial pins them or sampling is deterministic
+        coalesce = trial is not None or self.temperature == 0
+        key = self.cache_key(request, trial) if coalesce or self.cache or self.memory_cache else None
+        
+        # Serve repeated requests from the cache
+        completion = self.load_cached(key) if key and (self.cache or self.memory_cache) else None
+        if completion is not None:
+            return completion.choices[0].message.content, completion
+        
+        if not coalesce:
+            return await self.acomplete(request, key)
+        
+        # Join an identical request already in flight instead of sending another
+        flight = self.in_flight.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(self.acomplete(request, key))
+            self.in_flight[key] = flight
+            flight.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            logger.info(f"╰── Joined OpenAI Completion {key[:12]} already in flight.")
+        
+        # Shield the shared request so one cancelled waiter does not cancel it for the others
+        return await asyncio.shield(flight)
+    
+    async def acomplete(self, request: dict, key: str = None) -> str:
+        """
+        Send a chat completion request with rate limiting and retries.
+        
+        Parameters
+        ----------
+        request : dict
+            the request built by `build_request`
+        key : str
+            the cache key to store the completion under, if caching
+            
+        Returns
+        -------
+        Tuple[str, ChatCompletion]
+            the content of the first choice and the full completion
+            
+        Raises
+        ------
+        CompletionError
+            if the error is terminal or the retry budget is spent
+        """
+        
+        client = self.get_async_client()
+        
+        messages = request["messages"]
+        requested = estimate_tokens(messages) + self.max_tokens * (request["n"] or 1)
+        started = monotonic()
 
-        for attempt in range(max_retries):
+        for attempt in range(self.retry.max_attempts):
         
             try:
                 
-                logger.info(f"[A{attempt+1}] Running OpenAI Completion...")
-                logger.info(str(messages)[:200])
-                start = perf_counter()
+                queued = perf_counter()
                 
-                completion = await client.with_options(max_retries=10).chat.completions.create(
-                    messages=messages,
-                    model=self.model,
-                    frequency_penalty=self.frequency_penalty,
-                    presence_penalty=self.presence_penalty,
-                    max_tokens=self.max_tokens,
-                    seed=self.seed,
-                    temperature=self.temperature,
-                    top_p=self.top_p
-                )
+                # Take a concurrency slot before the rate and token budgets, so requests queued behind
+                # a small window neither spend tokens nor hold reservations they will send in a burst
+                async with self.concurrency or nullcontext():
+                    await self.limiter.acquire()
+                    if self.token_limiter:
+                        await self.token_limiter.acquire(requested)
+                    
+                    logger.info(f"[A{attempt+1}] Running OpenAI Completion...")
+                    logger.info(str(messages)[:200])
+                    
+                    start = perf_counter()
+                    if self.stream:
+                        completion, ttft = await self.arun_stream(client.with_options(timeout=self.retry.remaining(started)), request)
+                    else:
+                        completion, ttft = await client.with_options(timeout=self.retry.remaining(started)).chat.completions.create(**request), None
+                    end = perf_counter()
                 
-                end = perf_counter()
+                if self.concurrency:
+                    self.concurrency.record(end - start)
             
             except Exception as e:
-                tb = traceback.format_exc()
-                logger.error(f'{type(e).__name__} @ {__name__}: {e}\n{tb}')
-                await asyncio.sleep(1)
+                error = classify_error(e)
+                if error.kind == "unknown":
+                    tb = traceback.format_exc()
+                    logger.error(f'{type(e).__name__} @ {__name__}: {e}\n{tb}')
+                else:
+                    logger.error(f'[A{attempt+1}] {error}')
+                if self.concurrency and error.kind == "rate_limit":
+                    self.concurrency.overload()
+                if self.token_limiter:
+                    self.token_limiter.adjust(requested)
+                
+                # Terminal errors can never succeed, so hand them straight back
+                if not error.retryable:
+                    raise error from e
+                delay = self.retry.delay(attempt, error.headers)
+                if not self.retry.should_retry(attempt, started, delay):
+                    raise error from e
+                await asyncio.sleep(delay)
                 continue
             
             id = completion.id
@@ -248,8 +625,211 @@ class OpenAI:
             completion_tokens = completion.usage.completion_tokens
             total_tokens = completion.usage.total_tokens
             
+            self.metrics.record(end - start, queued=start - queued, ttft=ttft, tokens=completion_tokens)
+            
+            # Correct the budget with the real usage
+            if self.token_limiter:
+                self.token_limiter.adjust(requested - total_tokens)
+            
+            if key and (self.cache or self.memory_cache):
+                self.store_cached(key, completion)
+            
             logger.info(f"│\n         │\n{content}\n         │")
             logger.info(f"│   {created} {id} {fingerprint} {finish_reason} {prompt_tokens} {completion_tokens} {total_tokens}\n         │")
             logger.info(f"╰── Ran OpenAI Completion in {round(end - start, 2)} seconds.")
             
-            return content, completion
\ No newline at end of file
+            return content, completion
+    
+    def run_stream(self, client: openai.OpenAI, request: dict) -> Tuple[ChatCompletion, float]:
+        """
+        Stream a chat completion and assemble it from its chunks.
+        
+        With `stop_at_fence`, the request is cancelled as soon as the first
+        fenced code block of every choice closes, and the usage is estimated
+        from the chunks received.
+        
+        Parameters
+        ----------
+        client : openai.OpenAI
+            the client to send the request with
+        request : dict
+            the request built by `build_request`
+            
+        Returns
+        -------
+        Tuple[ChatCompletion, float]
+            the assembled completion and the seconds to the first token
+        """
+        accumulator = CompletionStream(
+            n=request["n"],
+            prompt_tokens=estimate_tokens(request["messages"]),
+            stop_at_fence=self.stop_at_fence,
+        )
+        
+        start = perf_counter()
+        stream = client.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+        try:
+            for chunk in stream:
+                if accumulator.add(chunk):
+                    logger.info(f"Stopped OpenAI Completion after the first code block.")
+                    break
+        finally:
+            stream.close()
+        
+        ttft = accumulator.first_token_at - start if accumulator.first_token_at else None
+        return accumulator.completion(), ttft
+    
+    async def arun_stream(self, client: openai.AsyncOpenAI, request: dict) -> Tuple[ChatCompletion, float]:
+        """
+        Stream a chat completion asynchronously and assemble it from its chunks.
+        
+        With `stop_at_fence`, the request is cancelled as soon as the first
+        fenced code block of every choice closes, and the usage is estimated
+        from the chunks received.
+        
+        Parameters
+        ----------
+        client : openai.AsyncOpenAI
+            the async client to send the request with
+        request : dict
+            the request built by `build_request`
+            
+        Returns
+        -------
+        Tuple[ChatCompletion, float]
+            the assembled completion and the seconds to the first token
+        """
+        accumulator = CompletionStream(
+            n=request["n"],
+            prompt_tokens=estimate_tokens(request["messages"]),
+            stop_at_fence=self.stop_at_fence,
+        )
+        
+        start = perf_counter()
+        stream = await client.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+        try:
+            async for chunk in stream:
+                if accumulator.add(chunk):
+                    logger.info(f"Stopped OpenAI Completion after the first code block.")
+                    break
+        finally:
+            await stream.close()
+        
+        ttft = accumulator.first_token_at - start if accumulator.first_token_at else None
+        return accumulator.completion(), ttft
+    
+    async def abatch(self, requests: Dict[str, List[Messages]], n: int = None, poll_interval: float = 30.0, max_batch_size: int = 50000) -> Dict[str, Union[ChatCompletion, CompletionError]]:
+        """
+        Run completions through the Batch API.
+        
+        The requests are written as Batch JSONL, uploaded and submitted in
+        chunks of at most `max_batch_size`, then polled until every batch
+        finishes and the output and error files are merged.
+        
+        Parameters
+        ----------
+        requests : Dict[str, List[Messages]]
+            the messages to run, keyed by a unique custom id
+        n : int
+            the number of choices to generate, defaults to the instance value
+        poll_interval : float
+            the seconds between batch status checks
+        max_batch_size : int
+            the maximum number of requests per batch
+            
+        Returns
+        -------
+        Dict[str, Union[ChatCompletion, CompletionError]]
+            the completion, or the error, for every custom id
+        
+        Example
+        -------
+        ```python
+        results = await openai.abatch({"row-1": [UserMessage("Hello")]})
+        ```
+        """
+        ids = list(requests)
+        chunks = [ids[i:i + max_batch_size] for i in range(0, len(ids), max_batch_size)]
+        batches = await asyncio.gather(*[
+            self.abatch_chunk({id: requests[id] for id in chunk}, n=n, poll_interval=poll_interval)
+            for chunk in chunks
+        ])
+        
+        results = {}
+        for batch in batches:
+            results.update(batch)
+        for id in ids:
+            if id not in results:
+                results[id] = CompletionError("unknown", Exception(f"{id} missing from batch output"))
+        return results
+    
+    async def abatch_chunk(self, requests: Dict[str, List[Messages]], n: int = None, poll_interval: float = 30.0) -> Dict[str, Union[ChatCompletion, CompletionError]]:
+        """
+        Submit a single batch and wait for its results.
+        
+        Parameters
+        ----------
+        requests : Dict[str, List[Messages]]
+            the messages to run, keyed by a unique custom id
+        n : int
+            the number of choices to generate, defaults to the instance value
+        poll_interval : float
+            the seconds between batch status checks
+            
+        Returns
+        -------
+        Dict[str, Union[ChatCompletion, CompletionError]]
+            the completion, or the error, for every custom id in the output
+        
+        Raises
+        ------
+        CompletionError
+            if the batch fails, expires or is cancelled
+        """
+        client = self.get_async_client().with_options(max_retries=self.retry.max_attempts)
+        
+        lines = [
+            json.dumps({
+                "custom_id": id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self.build_request([message.to_openai() for message in messages], n=n),
+            })
+            for id, messages in requests.items()
+        ]
+        
+        file = await client.files.create(file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+        batch = await client.batches.create(input_file_id=file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        logger.info(f"Submitted batch {batch.id} with {len(lines)} requests.")
+        
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(poll_interval)
+            batch = await client.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            logger.info(f"Batch {batch.id} {batch.status} {counts.completed if counts else 0}/{counts.total if counts else len(lines)}")
+        
+        if batch.status != "completed" and not batch.output_file_id:
+            raise CompletionError("unknown", Exception(f"Batch {batch.id} {batch.status}: {batch.errors}"))
+        
+        results = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await client.files.content(file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response") or {}
+                body = response.get("body") or {}
+                status = response.get("status_code")
+                if status == 200:
+                    results[record["custom_id"]] = ChatCompletion.model_validate(body)
+                    continue
+                error = body.get("error") or record.get("error") or {}
+                kind = classify_status(status, error.get("code")) if status else "unknown"
+                results[record["custom_id"]] = CompletionError(kind, Exception(error.get("message", "batch request failed")), status=status)
+        
+        logger.info(f"╰── Ran batch {batch.id} with {len(results)} results.")
+        
+        return results
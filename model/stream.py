@@ -0,0 +1,152 @@
+"""Contains the accumulator that turns streamed chunks into a completion."""
+
+from time import perf_counter
+from typing import Dict
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice, ChoiceLogprobs
+from openai.types.completion_usage import CompletionUsage
+
+from util.fence import FenceDetector
+
+class CompletionStream:
+    """
+    Accumulator for streamed chat completion chunks.
+
+    Each choice's deltas are fed through a FenceDetector, so with
+    `stop_at_fence` the caller can cancel the request as soon as every
+    choice has closed its first fenced code block. The result is assembled
+    into a regular ChatCompletion, with usage estimated from the chunk count
+    when the stream was cut before the server reported it.
+
+    Attributes
+    ----------
+    n : int
+        the number of choices requested
+    prompt_tokens : int
+        the estimated prompt tokens, used if usage is never reported
+    stop_at_fence : bool
+        whether to stop once the first fenced block of every choice closes
+    stopped : bool
+        whether the stream was stopped early
+    chunks : int
+        the number of content deltas received
+    first_token_at : float
+        the `perf_counter()` at which the first content delta arrived
+
+    Example
+    -------
+    ```python
+    from model.stream import CompletionStream
+
+    accumulator = CompletionStream(n=1, prompt_tokens=100, stop_at_fence=True)
+    async for chunk in stream:
+        if accumulator.add(chunk):
+            break
+    completion = accumulator.completion()
+    ```
+    """
+    n: int = 1
+    prompt_tokens: int = 0
+    stop_at_fence: bool = False
+    stopped: bool = False
+    chunks: int = 0
+    first_token_at: float = None
+
+    def __init__(self, n: int = 1, prompt_tokens: int = 0, stop_at_fence: bool = False) -> None:
+        """
+        Initialize the accumulator.
+
+        Parameters
+        ----------
+        n : int
+            the number of choices requested
+        prompt_tokens : int
+            the estimated prompt tokens, used if usage is never reported
+        stop_at_fence : bool
+            whether to stop once the first fenced block of every choice closes
+        """
+        self.n = n or 1
+        self.prompt_tokens = prompt_tokens
+        self.stop_at_fence = stop_at_fence
+        self.stopped = False
+        self.chunks = 0
+        self.first_token_at = None
+        self.detectors: Dict[int, FenceDetector] = {}
+        self.finish_reasons: Dict[int, str] = {}
+        self.logprobs: Dict[int, list] = {}
+        self.usage: CompletionUsage = None
+        self.first: ChatCompletionChunk = None
+
+    def add(self, chunk: ChatCompletionChunk) -> bool:
+        """
+        Add a chunk.
+
+        Parameters
+        ----------
+        chunk : ChatCompletionChunk
+            the streamed chunk
+
+        Returns
+        -------
+        bool
+            whether the caller should stop reading the stream
+        """
+        if self.first is None:
+            self.first = chunk
+        if chunk.usage:
+            self.usage = chunk.usage
+
+        for choice in chunk.choices:
+            detector = self.detectors.setdefault(choice.index, FenceDetector())
+            if choice.delta and choice.delta.content:
+                if self.first_token_at is None:
+                    self.first_token_at = perf_counter()
+                detector.feed(choice.delta.content)
+                self.chunks += 1
+            if choice.logprobs and choice.logprobs.content:
+                self.logprobs.setdefault(choice.index, []).extend(choice.logprobs.content)
+            if choice.finish_reason:
+                self.finish_reasons[choice.index] = choice.finish_reason
+
+        if self.stop_at_fence and len(self.detectors) == self.n and all(detector.closed for detector in self.detectors.values()):
+            self.stopped = True
+        return self.stopped
+
+    def completion(self) -> ChatCompletion:
+        """
+        Assemble the chunks into a completion.
+
+        Returns
+        -------
+        ChatCompletion
+            the completion, cut after the first fenced block if stopped early
+        """
+        choices = [
+            Choice(
+                index=index,
+                message=ChatCompletionMessage(
+                    role="assistant",
+                    content=detector.text[:detector.end] if self.stopped else detector.text,
+                ),
+                finish_reason=self.finish_reasons.get(index, "stop"),
+                logprobs=ChoiceLogprobs(content=self.logprobs[index]) if index in self.logprobs else None,
+            )
+            for index, detector in sorted(self.detectors.items())
+        ]
+
+        usage = self.usage or CompletionUsage(
+            prompt_tokens=self.prompt_tokens,
+            completion_tokens=self.chunks,
+            total_tokens=self.prompt_tokens + self.chunks,
+        )
+
+        return ChatCompletion(
+            id=self.first.id if self.first else "",
+            created=self.first.created if self.first else 0,
+            model=self.first.model if self.first else "",
+            object="chat.completion",
+            system_fingerprint=self.first.system_fingerprint if self.first else None,
+            choices=choices,
+            usage=usage,
+        )
@@ -1,94 +1,456 @@
 import csv
+import itertools
+import os
+import shutil
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from os import environ
 from model.openai import OpenAI
+from model.error import CompletionError
+from openai.types.chat import ChatCompletion
 from message.message import SystemMessage, UserMessage, ModelMessage
 import asyncio
 from pathlib import Path
+from typing import AsyncIterator, Iterator
+from util.log import Logger
+from util.sink import ArrowSink, CsvSink, JsonlSink, merge_arrow_files
+from util.checkpoint import Checkpoint
+from util.cache import MemoryCache, fingerprint
+from util.fence import extract_code
+from util.compress import detect_compression, open_text
+from util.index import CsvIndex
+from util.ingest import parallel_chunks
+
+logger = Logger(__name__)
 
 # Set your OpenAI API key
 OPENAI_API_KEY = environ.get("OPENAI_API_KEY")
 
+# Stream rows from the CSV file lazily, from row `start` up to but excluding row `stop`, decompressing gzip or zstd input
+def iter_data_from_csv(file_name: Path, start: int = 0, stop: int = None) -> Iterator[list[str]]:
+    with open_text(file_name) as file:
+        reader = csv.reader(file)
+        yield from itertools.islice(reader, start, stop)
+
+# Stream rows parsed by worker processes from row `start` up to but excluding row `stop`, waiting for each chunk in a thread so the event loop never blocks
+async def aiter_data_parallel(file_name: Path, start: int = 0, stop: int = None, workers: int = None) -> AsyncIterator[list[str]]:
+    chunks = parallel_chunks(file_name, workers=workers)
+    k = 0
+    try:
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            for row in chunk:
+                if stop is not None and k >= stop:
+                    return
+                if k >= start:
+                    yield row
+                k += 1
+    finally:
+        await asyncio.to_thread(chunks.close)
+
 # Read data from the CSV file
 def read_data_from_csv(file_name: Path) -> list[list[str]]:
-    data = []
-    with open(file_name, mode='r', newline='', encoding='utf-8') as file:
-        reader = csv.reader(file)
-        for row in reader:
-            data.append(row)
-    return data
+    return list(iter_data_from_csv(file_name))
 
-# Write data to a new CSV file
-def write_data_to_csv(file_name: Path, data: list[list[str]]):
-    with open(file_name, mode='w', newline='', encoding='utf-8') as file:
+# Write data to a new CSV file, optionally compressed with gzip or zstd
+def write_data_to_csv(file_name: Path, data: list[list[str]], compression: str = None, level: int = None):
+    with open_text(file_name, 'w', compression=compression, level=level) as file:
         writer = csv.writer(file)
         writer.writerows(data)
 
+# Normalize a prompt for deduplication, ignoring line endings and surrounding whitespace
+def normalize_prompt(prompt: str) -> str:
+    return "\n".join(line.rstrip() for line in prompt.strip().splitlines())
+
+# Build an output row from an input row and a sampled response
+def build_row(row_id: int, row: list[str], response: str, completion, trial: int, fallback: str = "raw") -> list:
+    # extract the first code block, falling back per policy when there is none
+    extraction = extract_code(response, fallback=fallback)
+    if extraction.fallback:
+        logger.warning(f"Row {row_id} trial {trial} has no code block, using {fallback!r} fallback.")
+    elif not extraction.complete:
+        logger.warning(f"Row {row_id} trial {trial} has an unterminated code block.")
+    
+    return [
+        extraction.code,  # model response
+        row[1],    # Class ID
+        row[2],    # Created
+        row[3],    # Prompt
+        row[4],    # QuestionID
+        row[5],    # Stderr
+        row[6],    # Stdout
+        row[7],    # UserEmail
+        row[8],    # UserIp
+        completion,  # Completion Object
+        trial,      # Trial Number
+        row_id,     # Input Row Number
+    ]
+
+# Build an output row for a request that failed, with the error in place of the completion
+def build_error_row(row_id: int, row: list[str], error: CompletionError, trial: int) -> list:
+    return [
+        "",        # model response
+        row[1],    # Class ID
+        row[2],    # Created
+        row[3],    # Prompt
+        row[4],    # QuestionID
+        row[5],    # Stderr
+        row[6],    # Stdout
+        row[7],    # UserEmail
+        row[8],    # UserIp
+        error,     # Completion Object
+        trial,     # Trial Number
+        row_id,    # Input Row Number
+    ]
+
+# Build the sidecar record for an output row, with the metadata of its choice or its error, and the usage only if the row accounts for the request
+def build_metadata(new_row: list, usage: bool = True) -> dict:
+    completion, trial, row_id = new_row[-3:]
+    if isinstance(completion, CompletionError):
+        return {"row_id": row_id, "trial": trial, "error": str(completion), "kind": completion.kind}
+    
+    # A collapsed request holds every trial as a choice, otherwise the only choice is the trial
+    choice = completion.choices[0] if len(completion.choices) == 1 else next(choice for choice in completion.choices if choice.index == trial - 1)
+    record = {
+        "row_id": row_id,
+        "trial": trial,
+        "id": completion.id,
+        "created": completion.created,
+        "system_fingerprint": completion.system_fingerprint,
+        "finish_reason": choice.finish_reason,
+        "usage": completion.usage.model_dump(exclude_none=True) if usage and completion.usage else None,
+    }
+    if choice.logprobs:
+        record["logprobs"] = choice.logprobs.model_dump()["content"]
+    return record
+
+# Build the output rows for a result, one per choice when every trial was fetched at once
+def build_rows(row_id: int, row: list[str], result, trial: int = None, trials: int = 1, fallback: str = "raw") -> list[list]:
+    if isinstance(result, CompletionError):
+        return [build_error_row(row_id, row, result, trial) for trial in ([trial] if trial is not None else range(1, trials + 1))]
+    if trial is None:
+        choices = sorted(result.choices, key=lambda choice: choice.index)
+        return [build_row(row_id, row, choice.message.content, result, choice.index + 1, fallback) for choice in choices]
+    return [build_row(row_id, row, result.choices[0].message.content, result, trial, fallback)]
+
 # Main function to process data
-async def process_data(input_file: Path, output_file: Path, limit: int = None, trials: int = 5):
+async def process_data(input_file: Path, output_file: Path, limit: int = None, trials: int = 5, max_concurrency: int = 1, collapse_trials: bool = False, adaptive_concurrency: bool = False, batch: bool = False, poll_interval: float = 30.0, offset: int = 0, api_key: str = None, flush_every: int = 100, checkpoint_file: Path = None, cache_file: Path = None, memory_cache_entries: int = None, memory_cache_bytes: int = None, dedupe: bool = False, dedupe_entries: int = 10000, stream: bool = False, fallback: str = "raw", output_format: str = "csv", metadata_file: Path = None, compression: str = None, compression_level: int = None, indexed: bool = False, parse_workers: int = None, calls_per_second: float = 5.0, tokens_per_minute: int = None, base_url: str = None):
     
     # Initialize the OpenAI model
-    openai = OpenAI(
-        OPENAI_API_KEY,
+    async with OpenAI(
+        api_key or OPENAI_API_KEY,
         model="gpt-4-turbo",
+        base_url=base_url,
         temperature=0.2,
-    )
+        calls_per_second=calls_per_second,
+        tokens_per_minute=tokens_per_minute,
+        adaptive_concurrency=adaptive_concurrency,
+        cache=cache_file,
+        memory_cache=MemoryCache(memory_cache_entries, memory_cache_bytes) if memory_cache_entries or memory_cache_bytes else None,
+        stream=stream,
+        stop_at_fence=stream,
+    ) as openai:
+        
+        # Load the (row, trial) pairs finished by an earlier run, if resuming
+        checkpoint = Checkpoint(checkpoint_file) if checkpoint_file else None
+        resume = bool(checkpoint and checkpoint.done)
+        if resume:
+            logger.info(f"Resuming with {len(checkpoint.done)} trials already done.")
     
-    # Read data from the input CSV
-    data = read_data_from_csv(input_file)
-    new_data = []
-    new_data.append([
-        "model_response",  # Model Response
-        "class_id",   # Class ID
-        "created",   # Created
-        "prompt",    # Prompt
-        "question_id",  # Question ID
-        "stderr",    # Stderr
-        "stdout",    # Stdout
-        "user_email", # User Email
-        "user_ip",    # User IP
-        "completion_object",  # Completion Object
-        "trial_id",     # Trial Number
-    ])
-
-    # Iterate over each row
-    for i, row in enumerate(data[1:], start=1):  # Skip the header row
-        if limit is not None and i > limit:
-            break
-        prompt = row[3]  # Fetch the prompt from the "Prompt" column
-        for trial in range(1, trials + 1):  # Generate 5 trials
+        # The output columns
+        header = [
+            "model_response",  # Model Response
+            "class_id",   # Class ID
+            "created",   # Created
+            "prompt",    # Prompt
+            "question_id",  # Question ID
+            "stderr",    # Stderr
+            "stdout",    # Stdout
+            "user_email", # User Email
+            "user_ip",    # User IP
+            "completion_object",  # Completion Object
+            "trial_id",     # Trial Number
+            "row_id",       # Input Row Number
+        ]
+        
+        # Open the metadata sidecar, if any
+        sidecar = JsonlSink(metadata_file, flush_every=flush_every, append=resume, sync=checkpoint is not None, compression=compression, level=compression_level) if metadata_file else None
+        
+        # After the rows are flushed, flush the sidecar and only then the checkpoint
+        def on_flush():
+            if sidecar:
+                sidecar.flush()
+            if checkpoint:
+                checkpoint.flush()
+        
+        # Open the output sink, rows are appended as they complete
+        if output_format == "csv":
+            sink = CsvSink(output_file, header, flush_every=flush_every, append=resume, sync=checkpoint is not None, on_flush=on_flush, compression=compression, level=compression_level)
+        else:
+            sink = ArrowSink(
+                output_file,
+                header,
+                format=output_format,
+                flush_every=flush_every,
+                append=resume,
+                sync=checkpoint is not None,
+                on_flush=on_flush,
+                dictionary_columns=["class_id", "prompt", "question_id"],
+                integer_columns=["trial_id", "row_id"],
+            )
+        with sidecar or nullcontext(), sink, CsvIndex(input_file) if indexed else nullcontext() as index:
             
-            messages = [
-                UserMessage(prompt),
-            ]
+            # Record the rows once written, the checkpoint is flushed right after the sink; `owner` is whether these rows sent their request
+            def write(new_rows: list[list], owner: bool = True):
+                # Only successful rows and terminal errors are done; retryable failures are sampled again on resume, so they are not written either
+                if checkpoint:
+                    new_rows = [new_row for new_row in new_rows if not (isinstance(new_row[-3], CompletionError) and new_row[-3].retryable)]
+                    if not new_rows:
+                        return
+                done = [(new_row[-1], new_row[-2]) for new_row in new_rows]
+
+                # Move the completion metadata to the sidecar, keeping the completion ID as a reference;
+                # rows sharing one request, its trials when collapsed or its duplicates, only count its usage once
+                if sidecar:
+                    sidecar.write([build_metadata(new_row, usage=owner and k == 0) for k, new_row in enumerate(new_rows)])
+                    new_rows = [new_row[:-3] + [new_row[-3].id if isinstance(new_row[-3], ChatCompletion) else new_row[-3]] + new_row[-2:] for new_row in new_rows]
+                sink.write(new_rows)
+                if checkpoint:
+                    checkpoint.mark(done)
+            
+            # Check whether every trial of the job was finished by an earlier run
+            def is_done(row_id: int, trial: int = None) -> bool:
+                if not checkpoint:
+                    return False
+                return all((row_id, trial) in checkpoint.done for trial in ([trial] if trial is not None else range(1, trials + 1)))
+    
+            # Stream the rows to sample from the input CSV, skipping the header row and the first `offset` rows
+            stop = 1 + offset + limit if limit is not None else None
+            if index is not None:
+                # Seek straight to the rows, skipping the ones finished by an earlier run without parsing them
+                stop = len(index) if stop is None else min(stop, len(index))
+                rows = ((row_id, index.row(row_id)) for row_id in range(1 + offset, stop) if not is_done(row_id))
+            else:
+                rows = enumerate(iter_data_from_csv(input_file, 1 + offset, stop), start=1 + offset)
             
-            response, completion = await openai.arun(messages)
+            # Compressed input cannot be split into byte ranges, so it is always parsed in this process
+            parallel = bool(parse_workers)
+            if parallel and detect_compression(input_file):
+                logger.warning(f"Parsing compressed input {input_file} serially, parse_workers needs a plain CSV file.")
+                parallel = False
             
-            # convert python code block to plain
-            response = response.replace("```python", "```")
-            # extract code block and save to response
-            response = response.split("```")[1]
+            # Iterate the rows, parsing them in worker processes without blocking the event loop if asked to
+            async def iter_rows() -> AsyncIterator[tuple[int, list[str]]]:
+                if parallel:
+                    row_id = 1 + offset
+                    async for row in aiter_data_parallel(input_file, 1 + offset, stop, workers=parse_workers):
+                        yield row_id, row
+                        row_id += 1
+                    return
+                for row_id, row in rows:
+                    yield row_id, row
+        
+            # Fetch every row, or every (row, trial) pair, through the Batch API
+            if batch:
+                rows = [(row_id, row) async for row_id, row in iter_rows()]
+                requests = {}
+                custom_ids = {}
+                unique = {}
+                for row_id, row in rows:
+                    messages = [UserMessage(row[3])]
+                    for trial in ([None] if collapse_trials else range(1, trials + 1)):
+                        if is_done(row_id, trial):
+                            continue
+                        custom_id = f"row-{row_id}" if trial is None else f"row-{row_id}-trial-{trial}"
+                        # Identical prompts share the request of their first row
+                        if dedupe:
+                            custom_id = unique.setdefault((normalize_prompt(row[3]), trial), custom_id)
+                        custom_ids[row_id, trial] = custom_id
+                        requests.setdefault(custom_id, messages)
             
-            new_row = [
-                response,  # model response
-                row[1],    # Class ID
-                row[2],    # Created
-                prompt,    # Prompt
-                row[4],    # QuestionID
-                row[5],    # Stderr
-                row[6],    # Stdout
-                row[7],    # UserEmail
-                row[8],    # UserIp
-                completion,  # Completion Object
-                trial,      # Trial Number
-            ]
-            new_data.append(new_row)
+                results = await openai.abatch(requests, n=trials if collapse_trials else None, poll_interval=poll_interval)
+            
+                # Merge the results back in input order, fanning shared results out to every matching row
+                for row_id, row in rows:
+                    for trial in ([None] if collapse_trials else range(1, trials + 1)):
+                        if (row_id, trial) in custom_ids:
+                            owner = custom_ids[row_id, trial] == (f"row-{row_id}" if trial is None else f"row-{row_id}-trial-{trial}")
+                            write(build_rows(row_id, row, results[custom_ids[row_id, trial]], trial, trials, fallback), owner)
+                return
+
+            # Request one trial for a prompt, or every trial at once when trial is None
+            async def request(row_id: int, prompt: str, trial: int = None):
+                messages = [
+                    UserMessage(prompt),
+                ]
+                
+                # Rows only share a sample when deduplicating, otherwise the row keeps identical prompts apart
+                key = trial if dedupe else (row_id, trial)
+            
+                try:
+                    _, result = await openai.arun(messages, n=trials if trial is None else None, trial=key)
+                except CompletionError as error:
+                    logger.error(f"Prompt {prompt[:40]!r} trial {trial or 'all'} failed: {error}")
+                    result = error
+                return result
+            
+            # Requests in flight shared by rows with the same normalized prompt, when deduplicating
+            samples = {}
+            
+            # Results of finished shared requests, bounded so memory does not grow with the dataset
+            finished = MemoryCache(dedupe_entries)
+            unique = 0
+
+            # Sample one trial for a row, or every trial at once when trial is None, and tell whether this row sent the request
+            async def sample(row_id: int, row: list[str], trial: int = None) -> tuple[list[list], bool]:
+                nonlocal unique
+                prompt = row[3]  # Fetch the prompt from the "Prompt" column
+                
+                owner = True
+                if dedupe:
+                    key = fingerprint([normalize_prompt(prompt), trial])
+                    result = finished.get(key)
+                    owner = result is None and key not in samples
+                    if result is None and key in samples:
+                        result = await samples[key]
+                    elif result is None:
+                        # The first row with this prompt sends the request and hands the result over once done
+                        unique += 1
+                        samples[key] = asyncio.ensure_future(request(row_id, prompt, trial))
+                        try:
+                            result = await samples[key]
+                        finally:
+                            del samples[key]
+                        if not isinstance(result, CompletionError):
+                            finished.set(key, result)
+                else:
+                    result = await request(row_id, prompt, trial)
+                return build_rows(row_id, row, result, trial, trials, fallback), owner
+
+            # Generate every unfinished (row, trial) pair lazily, or one job per row when collapsing
+            async def generate_jobs() -> AsyncIterator[tuple[int, list[str], int]]:
+                async for row_id, row in iter_rows():
+                    if collapse_trials:
+                        if not is_done(row_id):
+                            yield row_id, row, None
+                        continue
+                    for trial in range(1, trials + 1):  # Generate the trials
+                        if not is_done(row_id, trial):
+                            yield row_id, row, trial
+        
+            jobs = generate_jobs()
+            next_job = asyncio.Lock()
+        
+            # Each worker pulls the next job as soon as it is free and writes its rows as soon as they complete
+            async def worker():
+                while True:
+                    # One worker at a time advances the shared generator
+                    async with next_job:
+                        try:
+                            row_id, row, trial = await jobs.__anext__()
+                        except StopAsyncIteration:
+                            return
+                    write(*await sample(row_id, row, trial))
+        
+            # With adaptive concurrency the controller bounds the requests in flight, so start enough workers for its largest window
+            workers = max(max_concurrency, openai.concurrency.max_limit) if openai.concurrency else max_concurrency
+            await asyncio.gather(*[worker() for _ in range(workers)])
+
+            logger.info(f"Latency profile: {openai.metrics.summary()}")
+            if dedupe:
+                logger.info(f"Deduplicated to {unique} requests, {finished.stats()}.")
+            if openai.concurrency:
+                logger.info(f"Final concurrency window: {openai.concurrency.window}")
+            if openai.memory_cache:
+                logger.info(f"Memory cache: {openai.memory_cache.stats()}")
+            if openai.cache:
+                logger.info(f"Disk cache: {openai.cache.stats()}")
 
-    # Write the new data into a new CSV file
-    write_data_to_csv(output_file, new_data)
+# Run one shard of the input in its own process and event loop, with its own metadata sidecar and checkpoint
+def process_shard(input_file: Path, output_file: Path, offset: int, limit: int, api_key: str, options: dict) -> Path:
+    if options.get("metadata_file"):
+        options = {**options, "metadata_file": output_file.with_suffix(".jsonl")}
+    if options.get("checkpoint_file"):
+        options = {**options, "checkpoint_file": output_file.with_suffix(".checkpoint")}
+    asyncio.run(process_data(input_file, output_file, limit=limit, offset=offset, api_key=api_key, **options))
+    return output_file
 
-# Input and Output file names
-input_file = Path('data/input/attempts-2023-07-29T08_36_51.352Z.csv')
-output_file = Path('data/output/attempts-2023-07-29T08_36_51.352Z-sampled.csv')
+# Concatenate shard outputs in order, keeping only the first header
+def merge_csv_files(file_names: list[Path], output_file: Path, compression: str = None, level: int = None):
+    with open_text(output_file, 'w', compression=compression, level=level) as output:
+        for k, file_name in enumerate(file_names):
+            with open_text(file_name) as file:
+                header = file.readline()
+                if k == 0:
+                    output.write(header)
+                shutil.copyfileobj(file, output)
 
-# Call the main function to process the data
-asyncio.run(process_data(input_file, output_file, limit=1, trials=3))
\ No newline at end of file
+# Split the input across worker processes, each with its own OpenAI instance and optional API key, sharing the rate budgets of its key
+def process_sharded(input_file: Path, output_file: Path, shards: int = None, api_keys: list[str] = None, limit: int = None, calls_per_second: float = 5.0, tokens_per_minute: int = None, **options):
+    shards = shards or os.cpu_count()
+    api_keys = api_keys or [OPENAI_API_KEY]
+    
+    # Size the shards from the number of rows to process, building the index once for every shard if seeking by offset
+    if options.get("indexed"):
+        with CsvIndex(input_file) as index:
+            total = len(index) - 1
+    else:
+        total = sum(1 for _ in iter_data_from_csv(input_file, 1))
+    if limit is not None:
+        total = min(total, limit)
+    size = -(-total // shards)
+    
+    # Keep the shard outputs and journals next to the checkpoint when resumable, so a rerun appends to them
+    if options.get("checkpoint_file"):
+        shard_directory = nullcontext(options["checkpoint_file"].with_name(options["checkpoint_file"].name + ".shards"))
+    else:
+        shard_directory = tempfile.TemporaryDirectory(dir=output_file.parent)
+    
+    # The limits apply per key, so the shards on one key split its request and token rates between them
+    keys = [api_keys[k % len(api_keys)] for k in range(shards) if k * size < total]
+    sharing = Counter(keys)
+    
+    with shard_directory as directory:
+        Path(directory).mkdir(exist_ok=True)
+        with ProcessPoolExecutor(max_workers=shards) as executor:
+            futures = [
+                executor.submit(
+                    process_shard,
+                    input_file,
+                    # Named by range, so a rerun with a different shard layout never resumes the wrong rows
+                    Path(directory) / f"shard-{k * size}-{min(size, total - k * size)}.{options.get('output_format', 'csv')}",
+                    k * size,
+                    min(size, total - k * size),
+                    key,
+                    {
+                        **options,
+                        "calls_per_second": calls_per_second / sharing[key],
+                        "tokens_per_minute": tokens_per_minute // sharing[key] if tokens_per_minute else None,
+                    },
+                )
+                for k, key in enumerate(keys)
+            ]
+            shard_files = [future.result() for future in futures]
+        
+        # Merge the shards back in input order
+        if options.get("output_format", "csv") == "csv":
+            merge_csv_files(shard_files, output_file, options.get("compression"), options.get("compression_level"))
+        else:
+            merge_arrow_files(shard_files, output_file, options["output_format"])
+        
+        # Concatenate the shard sidecars in the same order, gzip members and zstd frames concatenate too
+        if options.get("metadata_file"):
+            with open(options["metadata_file"], mode='wb') as output:
+                for shard_file in shard_files:
+                    with open(shard_file.with_suffix(".jsonl"), mode='rb') as file:
+                        shutil.copyfileobj(file, output)
+
+if __name__ == "__main__":
+    
+    # Input and Output file names
+    input_file = Path('data/input/attempts-2023-07-29T08_36_51.352Z.csv')
+    output_file = Path('data/output/attempts-2023-07-29T08_36_51.352Z-sampled.csv')
+    
+    # Call the main function to process the data
+    asyncio.run(process_data(input_file, output_file, limit=1, trials=3, max_concurrency=8))
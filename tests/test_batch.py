@@ -0,0 +1,311 @@
+"""Contains tests of the Batch API mode against a local mock of the files and batches endpoints.
+
+Run from the repository root with `python -m unittest tests/test_batch.py`.
+"""
+
+import asyncio
+import csv
+import email
+import json
+import re
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from message.message import UserMessage
+from model.error import CompletionError
+from model.openai import OpenAI
+from run import process_data
+
+class MockBatchServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the files and batches endpoints of the OpenAI API.
+
+    Uploaded requests are answered when the batch is submitted, but the
+    batch only reports completed on its second status check, so clients
+    have to poll. Requests whose last message contains "fail" go to the
+    error file as a 400 context_length_exceeded, like the real API.
+
+    Attributes
+    ----------
+    files : dict
+        the content of every file, keyed by file id
+    batches : dict
+        the state of every batch, keyed by batch id
+    requests : list
+        the custom id of every request submitted, in order
+    checks : int
+        the number of batch status checks
+    url : str
+        the base URL to point the OpenAI client at
+    """
+    files: dict
+    batches: dict
+    requests: list
+    checks: int = 0
+    url: str
+
+    def __init__(self) -> None:
+        """
+        Bind to a free local port.
+        """
+        super().__init__(("127.0.0.1", 0), MockBatchHandler)
+        self.files = {}
+        self.batches = {}
+        self.requests = []
+        self.checks = 0
+        self.url = f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def add_file(self, content: bytes) -> dict:
+        """
+        Store a file and describe it.
+        """
+        id = f"file-{len(self.files)}"
+        self.files[id] = content
+        return {"id": id, "object": "file", "bytes": len(content), "created_at": 0, "filename": "batch.jsonl", "purpose": "batch", "status": "processed"}
+
+    def complete(self, line: dict) -> dict:
+        """
+        Answer one Batch JSONL request with a completion or an error.
+        """
+        body = line["body"]
+        prompt = body["messages"][-1]["content"]
+        prompt = prompt if isinstance(prompt, str) else prompt[0]["text"]
+        if "fail" in prompt:
+            error = {"message": "prompt too long", "type": "invalid_request_error", "code": "context_length_exceeded"}
+            return {"id": f"req-{line['custom_id']}", "custom_id": line["custom_id"], "response": {"status_code": 400, "body": {"error": error}}, "error": None}
+        choices = [
+            {"index": k, "message": {"role": "assistant", "content": f"```python\nprint({prompt!r}, {k})\n```"}, "finish_reason": "stop", "logprobs": None}
+            for k in range(body.get("n") or 1)
+        ]
+        completion = {
+            "id": f"chatcmpl-{line['custom_id']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "system_fingerprint": "fp_mock",
+            "choices": choices,
+            "usage": {"prompt_tokens": 10, "completion_tokens": 20, "total_tokens": 30},
+        }
+        return {"id": f"req-{line['custom_id']}", "custom_id": line["custom_id"], "response": {"status_code": 200, "body": completion}, "error": None}
+
+    def submit(self, body: dict) -> dict:
+        """
+        Answer every request of an uploaded file into an output and an error file.
+        """
+        lines = [json.loads(line) for line in self.files[body["input_file_id"]].decode("utf-8").splitlines() if line.strip()]
+        self.requests.extend(line["custom_id"] for line in lines)
+        records = [self.complete(line) for line in lines]
+        output = [record for record in records if record["response"]["status_code"] == 200]
+        errors = [record for record in records if record["response"]["status_code"] != 200]
+
+        id = f"batch-{len(self.batches)}"
+        self.batches[id] = {
+            "id": id,
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"],
+            "status": "validating",
+            "created_at": 0,
+            "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+            # Held back until the batch completes
+            "_output_file_id": self.add_file("\n".join(json.dumps(record) for record in output).encode("utf-8"))["id"] if output else None,
+            "_error_file_id": self.add_file("\n".join(json.dumps(record) for record in errors).encode("utf-8"))["id"] if errors else None,
+            "_failed": len(errors),
+        }
+        return self.describe(id)
+
+    def retrieve(self, id: str) -> dict:
+        """
+        Check a batch, which moves on by one status every time.
+        """
+        self.checks += 1
+        batch = self.batches[id]
+        if batch["status"] == "validating":
+            batch["status"] = "in_progress"
+        elif batch["status"] == "in_progress":
+            batch["status"] = "completed"
+            batch["output_file_id"] = batch["_output_file_id"]
+            batch["error_file_id"] = batch["_error_file_id"]
+            total = batch["request_counts"]["total"]
+            batch["request_counts"] = {"total": total, "completed": total - batch["_failed"], "failed": batch["_failed"]}
+        return self.describe(id)
+
+    def describe(self, id: str) -> dict:
+        """
+        The public fields of a batch.
+        """
+        return {key: value for key, value in self.batches[id].items() if not key.startswith("_")}
+
+class MockBatchHandler(BaseHTTPRequestHandler):
+    """
+    Routes the files and batches endpoints to the MockBatchServer.
+    """
+    server: MockBatchServer
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path == "/v1/files":
+            # The file is the multipart part that has a file name
+            message = email.message_from_bytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + body)
+            content = next(part.get_payload(decode=True) for part in message.get_payload() if part.get_filename())
+            self.reply(self.server.add_file(content))
+        elif self.path == "/v1/batches":
+            self.reply(self.server.submit(json.loads(body)))
+        else:
+            self.reply({"error": {"message": f"unknown path {self.path}"}}, status=404)
+
+    def do_GET(self) -> None:
+        if match := re.fullmatch(r"/v1/batches/([^/]+)", self.path):
+            self.reply(self.server.retrieve(match.group(1)))
+        elif match := re.fullmatch(r"/v1/files/([^/]+)/content", self.path):
+            self.reply(self.server.files[match.group(1)], content_type="application/octet-stream")
+        else:
+            self.reply({"error": {"message": f"unknown path {self.path}"}}, status=404)
+
+    def reply(self, body, status: int = 200, content_type: str = "application/json") -> None:
+        data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args) -> None:
+        pass
+
+class TestBatch(unittest.TestCase):
+    """
+    Upload, submit, poll and merge through the mock server.
+    """
+
+    def setUp(self) -> None:
+        self.server = MockBatchServer()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def write_input(self, prompts: list) -> Path:
+        """
+        Write an input CSV with one row per prompt.
+        """
+        input_file = Path(self.directory.name) / "input.csv"
+        with open(input_file, mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(["id", "class_id", "created", "prompt", "question_id", "stderr", "stdout", "user_email", "user_ip"])
+            for k, prompt in enumerate(prompts):
+                writer.writerow([k, "class", "2023-07-29", prompt, f"q{k}", "", "", "user@example.com", "127.0.0.1"])
+        return input_file
+
+    def read_output(self, output_file: Path) -> list:
+        """
+        Read the output rows as dictionaries.
+        """
+        with open(output_file, newline='', encoding='utf-8') as file:
+            return list(csv.DictReader(file))
+
+    def test_abatch(self):
+        async def run():
+            async with OpenAI("sk-test", base_url=self.server.url) as openai:
+                return await openai.abatch(
+                    {
+                        "ok-1": [UserMessage("hello")],
+                        "ok-2": [UserMessage("world")],
+                        "bad": [UserMessage("please fail")],
+                    },
+                    poll_interval=0,
+                    max_batch_size=2,
+                )
+
+        results = asyncio.run(run())
+
+        # Split into two batches, each polled until completed
+        self.assertEqual(len(self.server.batches), 2)
+        self.assertGreaterEqual(self.server.checks, 4)
+        self.assertCountEqual(self.server.requests, ["ok-1", "ok-2", "bad"])
+
+        self.assertEqual(results["ok-1"].id, "chatcmpl-ok-1")
+        self.assertIn("hello", results["ok-1"].choices[0].message.content)
+        self.assertIn("world", results["ok-2"].choices[0].message.content)
+
+        # The record from the error file is a classified, terminal error
+        self.assertIsInstance(results["bad"], CompletionError)
+        self.assertEqual(results["bad"].kind, "context_length")
+        self.assertEqual(results["bad"].status, 400)
+        self.assertFalse(results["bad"].retryable)
+
+    def test_process_data_merge(self):
+        input_file = self.write_input(["alpha", "beta", "alpha ", "please fail"])
+        output_file = Path(self.directory.name) / "output.csv"
+        metadata_file = Path(self.directory.name) / "metadata.jsonl"
+
+        asyncio.run(process_data(
+            input_file,
+            output_file,
+            trials=2,
+            batch=True,
+            poll_interval=0,
+            api_key="sk-test",
+            base_url=self.server.url,
+            metadata_file=metadata_file,
+        ))
+
+        rows = self.read_output(output_file)
+        self.assertEqual([(row["row_id"], row["trial_id"]) for row in rows], [(str(k), str(t)) for k in range(1, 5) for t in (1, 2)])
+        self.assertEqual(len(self.server.requests), 8)
+        self.assertIn("beta", rows[2]["model_response"])
+        self.assertEqual(rows[0]["completion_object"], "chatcmpl-row-1-trial-1")
+
+        # The failed request is written as an error row and recorded in the sidecar
+        self.assertTrue(rows[6]["completion_object"].startswith("context_length (400)"))
+        with open(metadata_file, encoding='utf-8') as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual(records[6]["kind"], "context_length")
+        self.assertEqual(records[0]["usage"]["total_tokens"], 30)
+
+    def test_process_data_collapse_dedupe(self):
+        input_file = self.write_input(["alpha", "beta", "alpha ", "please fail"])
+        output_file = Path(self.directory.name) / "output.csv"
+        metadata_file = Path(self.directory.name) / "metadata.jsonl"
+
+        asyncio.run(process_data(
+            input_file,
+            output_file,
+            trials=3,
+            batch=True,
+            collapse_trials=True,
+            dedupe=True,
+            poll_interval=0,
+            api_key="sk-test",
+            base_url=self.server.url,
+            metadata_file=metadata_file,
+        ))
+
+        # Rows 1 and 3 share one request, and every request fetches all trials at once
+        self.assertEqual(self.server.requests, ["row-1", "row-2", "row-4"])
+
+        rows = self.read_output(output_file)
+        self.assertEqual([(row["row_id"], row["trial_id"]) for row in rows], [(str(k), str(t)) for k in range(1, 5) for t in (1, 2, 3)])
+        self.assertEqual([row["completion_object"] for row in rows[6:9]], ["chatcmpl-row-1"] * 3)
+        self.assertEqual([row["model_response"] for row in rows[6:9]], [row["model_response"] for row in rows[0:3]])
+        self.assertNotEqual(rows[0]["model_response"], rows[1]["model_response"])
+
+        # The failed request fans out to an error row for every trial
+        self.assertTrue(all(row["completion_object"].startswith("context_length (400)") for row in rows[9:12]))
+
+        # Usage is counted once per request across the rows that share it
+        with open(metadata_file, encoding='utf-8') as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual(sum(record["usage"]["total_tokens"] for record in records if record.get("usage")), 30 * 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,253 @@
+"""Contains the in-memory and persistent completion caches keyed by request fingerprint."""
+
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict
+
+def fingerprint(request: dict) -> str:
+    """
+    Hash a request into a stable cache key.
+
+    Parameters
+    ----------
+    request : dict
+        the request parameters, JSON serializable
+
+    Returns
+    -------
+    str
+        the hex SHA-256 digest of the canonical JSON encoding
+    """
+    encoded = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+class CompletionCache:
+    """
+    Content-addressed completion cache backed by SQLite.
+
+    The database runs in WAL mode so shards in separate processes can read
+    and write the same cache file concurrently.
+
+    Attributes
+    ----------
+    file_name : Path
+        the path of the SQLite database
+    hits : int
+        the number of lookups served from the database
+    misses : int
+        the number of lookups not found
+
+    Example
+    -------
+    ```python
+    from util.cache import CompletionCache, fingerprint
+
+    cache = CompletionCache(Path("completions.sqlite"))
+    key = fingerprint(request)
+    value = cache.get(key)
+    if value is None:
+        cache.set(key, completion.model_dump_json())
+    ```
+    """
+    file_name: Path
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self, file_name: Path) -> None:
+        """
+        Open the cache, creating the database if needed.
+
+        Parameters
+        ----------
+        file_name : Path
+            the path of the SQLite database
+        """
+        self.file_name = file_name
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def get(self, key: str) -> str:
+        """
+        Look up a cached value.
+
+        Parameters
+        ----------
+        key : str
+            the request fingerprint
+
+        Returns
+        -------
+        str
+            the cached value, or None on a miss
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM completions WHERE key = ?", (key,)).fetchone()
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return row[0] if row else None
+
+    def set(self, key: str, value: str) -> None:
+        """
+        Store a value.
+
+        Parameters
+        ----------
+        key : str
+            the request fingerprint
+        value : str
+            the value to store
+        """
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO completions (key, value) VALUES (?, ?)", (key, value))
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the lookup counters.
+
+        Returns
+        -------
+        Dict[str, int]
+            the hits and misses
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        """
+        Close the database connection.
+        """
+        with self.lock:
+            self.connection.close()
+
+class MemoryCache:
+    """
+    Bounded in-memory LRU cache of decoded values.
+
+    Entries are evicted least recently used first once either the entry
+    limit or the byte limit is exceeded. Sizes are supplied by the caller,
+    typically the length of the serialized value, so lookups never pay for
+    measuring or decoding.
+
+    Attributes
+    ----------
+    max_entries : int
+        the maximum number of entries, unbounded if None
+    max_bytes : int
+        the maximum total size of the entries, unbounded if None
+    size : int
+        the current total size of the entries
+    hits : int
+        the number of lookups served from memory
+    misses : int
+        the number of lookups not found
+    evictions : int
+        the number of entries evicted to respect the limits
+
+    Example
+    -------
+    ```python
+    from util.cache import MemoryCache
+
+    cache = MemoryCache(max_entries=10000, max_bytes=256 * 2**20)
+    cache.set(key, completion, size=len(value))
+    completion = cache.get(key)
+    ```
+    """
+    max_entries: int = None
+    max_bytes: int = None
+    size: int = 0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = None) -> None:
+        """
+        Initialize the cache.
+
+        Parameters
+        ----------
+        max_entries : int
+            the maximum number of entries, unbounded if None
+        max_bytes : int
+            the maximum total size of the entries, unbounded if None
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        """
+        Look up a value and mark it as recently used.
+
+        Parameters
+        ----------
+        key : str
+            the request fingerprint
+
+        Returns
+        -------
+        Any
+            the cached value, or None on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, value: Any, size: int = 0) -> None:
+        """
+        Store a value, evicting the least recently used entries if needed.
+
+        Parameters
+        ----------
+        key : str
+            the request fingerprint
+        value : Any
+            the value to store
+        size : int
+            the size of the value in bytes
+        """
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.entries and (
+                (self.max_entries is not None and len(self.entries) > self.max_entries)
+                or (self.max_bytes is not None and self.size > self.max_bytes)
+            ):
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the lookup and eviction counters.
+
+        Returns
+        -------
+        Dict[str, int]
+            the hits, misses, evictions, entries and bytes
+        """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self.entries), "bytes": self.size}
@@ -0,0 +1,82 @@
+"""Contains the checkpoint journal for resuming interrupted runs."""
+
+import os
+from pathlib import Path
+from typing import Iterable, Set, Tuple
+
+class Checkpoint:
+    """
+    Append-only journal of the (row, trial) pairs already written.
+
+    Pairs are buffered by `mark` and appended to the journal by `flush`,
+    which the output sink calls right after its own rows reach the disk, so
+    a pair is never recorded before its output row. A crash can at worst
+    repeat the last unflushed batch, never lose one.
+
+    Attributes
+    ----------
+    file_name : Path
+        the path of the journal
+    done : Set[Tuple[int, int]]
+        the (row_id, trial_id) pairs already completed
+
+    Example
+    -------
+    ```python
+    from util.checkpoint import Checkpoint
+
+    checkpoint = Checkpoint(Path("run.checkpoint"))
+    if (row_id, trial) not in checkpoint.done:
+        ...
+    checkpoint.mark([(row_id, trial)])
+    checkpoint.flush()
+    ```
+    """
+    file_name: Path
+    done: Set[Tuple[int, int]]
+
+    def __init__(self, file_name: Path) -> None:
+        """
+        Load the pairs recorded by previous runs.
+
+        Parameters
+        ----------
+        file_name : Path
+            the path of the journal
+        """
+        self.file_name = file_name
+        self.done = set()
+        self.pending = []
+
+        if file_name.exists():
+            with open(file_name, mode='r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        row_id, trial = line.split(",")
+                        self.done.add((int(row_id), int(trial)))
+                    except ValueError:
+                        continue  # torn last line from a crash
+
+    def mark(self, pairs: Iterable[Tuple[int, int]]) -> None:
+        """
+        Buffer completed pairs until the next flush.
+
+        Parameters
+        ----------
+        pairs : Iterable[Tuple[int, int]]
+            the (row_id, trial_id) pairs to record
+        """
+        self.pending.extend(pairs)
+
+    def flush(self) -> None:
+        """
+        Append the buffered pairs to the journal and sync it to disk.
+        """
+        if not self.pending:
+            return
+        with open(self.file_name, mode='a', encoding='utf-8') as file:
+            file.writelines(f"{row_id},{trial}\n" for row_id, trial in self.pending)
+            file.flush()
+            os.fsync(file.fileno())
+        self.done.update(self.pending)
+        self.pending = []
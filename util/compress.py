@@ -0,0 +1,218 @@
+"""Contains helpers to read and write text files through a streaming compressor."""
+
+import gzip
+import io
+import os
+import zlib
+from pathlib import Path
+from typing import IO, Literal
+
+from util.log import Logger
+
+logger = Logger(__name__)
+
+Compression = Literal["gzip", "zstd"]
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+def detect_compression(file_name: Path) -> Compression:
+    """
+    Detect the compression of a file from its magic bytes.
+
+    Parameters
+    ----------
+    file_name : Path
+        the path of the file
+
+    Returns
+    -------
+    Compression
+        "gzip" or "zstd", or None if the file is plain or empty
+    """
+    with open(file_name, mode='rb') as file:
+        magic = file.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+def import_zstandard():
+    """
+    Import the optional zstandard package.
+
+    Returns
+    -------
+    module
+        the zstandard module
+
+    Raises
+    ------
+    ImportError
+        if zstandard is not installed
+    """
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("zstd compression requires zstandard, install it with `pip install zstandard`") from e
+    return zstandard
+
+def salvage(file_name: Path, compression: Compression, level: int = None, block_size: int = 2**20) -> bool:
+    """
+    Finish a compressed file left unfinished by a crash, so it can be appended to.
+
+    A gzip member or zstd frame that was never closed still decodes up to
+    its last flush, but a member or frame appended after it cannot be
+    decoded at all. The file is read once; if its last member or frame is
+    unfinished, the text recovered up to its last newline is written again
+    as one complete stream, replacing the file atomically.
+
+    Parameters
+    ----------
+    file_name : Path
+        the path of the compressed file
+    compression : Compression
+        the compression of the file
+    level : int
+        the compression level of the rewritten file, the library default if None
+    block_size : int
+        the compressed bytes read at a time
+
+    Returns
+    -------
+    bool
+        whether the file was unfinished and had to be rewritten
+    """
+    if compression == "gzip":
+        new_decompressor = lambda: zlib.decompressobj(wbits=31)
+        errors = (zlib.error,)
+    else:
+        zstandard = import_zstandard()
+        new_decompressor = lambda: zstandard.ZstdDecompressor().decompressobj()
+        errors = (zstandard.ZstdError,)
+
+    temporary = file_name.with_name(file_name.name + ".tmp")
+    with open(file_name, mode='rb') as source, open_binary(temporary, compression, level) as target:
+        decompressor = new_decompressor()
+        started = False
+        complete = True
+        tail = b""
+        while block := source.read(block_size):
+            while block:
+                try:
+                    data = decompressor.decompress(block)
+                except errors:
+                    # Anything after a corrupt block is lost, keep what came before it
+                    complete = False
+                    break
+                started = True
+
+                # Only write whole lines, the text after the last newline may be cut off
+                data = tail + data
+                cut = data.rfind(b"\n") + 1
+                target.write(data[:cut])
+                tail = data[cut:]
+
+                # The next member or frame starts right after the end of this one
+                block = decompressor.unused_data if decompressor.eof else b""
+                if decompressor.eof:
+                    decompressor = new_decompressor()
+                    started = False
+            if not complete:
+                break
+        complete = complete and not started
+
+    if complete:
+        os.remove(temporary)
+        return False
+    os.replace(temporary, file_name)
+    return True
+
+def open_binary(file_name: Path, compression: Compression, level: int = None) -> IO[bytes]:
+    """
+    Open a binary file for writing through a streaming compressor.
+
+    Parameters
+    ----------
+    file_name : Path
+        the path of the file
+    compression : Compression
+        the compression to write with
+    level : int
+        the compression level, the library default if None
+
+    Returns
+    -------
+    IO[bytes]
+        the binary file
+    """
+    if compression == "gzip":
+        return gzip.open(file_name, mode='wb', compresslevel=9 if level is None else level)
+    zstandard = import_zstandard()
+    return zstandard.ZstdCompressor(level=3 if level is None else level).stream_writer(open(file_name, mode='wb'), closefd=True)
+
+def open_text(file_name: Path, mode: Literal["r", "w", "a"] = "r", compression: Compression = None, level: int = None) -> IO[str]:
+    """
+    Open a text file, compressed or not, for streaming reads or writes.
+
+    When reading, the compression is detected from the magic bytes, so
+    plain, gzip and zstd inputs are all read transparently. When writing,
+    every flush of the returned file also flushes the compressor, so the
+    data flushed so far can be recovered even if the process dies before
+    the stream is closed. Appending first finishes a stream left unfinished
+    by a crash with `salvage`, dropping any cut-off last line, then adds a
+    new gzip member or zstd frame, both of which decode as one stream.
+
+    Parameters
+    ----------
+    file_name : Path
+        the path of the file
+    mode : Literal["r", "w", "a"]
+        read, write or append
+    compression : Compression
+        the compression to write with, ignored when reading
+    level : int
+        the compression level, the library default if None
+
+    Returns
+    -------
+    IO[str]
+        the text file, with newline translation disabled for the csv module
+
+    Raises
+    ------
+    ImportError
+        if zstd is needed and zstandard is not installed
+
+    Example
+    -------
+    ```python
+    from util.compress import open_text
+
+    with open_text(Path("out.csv.zst"), "w", compression="zstd", level=10) as file:
+        csv.writer(file).writerows(rows)
+    ```
+    """
+    if mode == "r":
+        compression = detect_compression(file_name) if file_name.exists() else None
+
+    if compression is None:
+        return open(file_name, mode=mode, newline='', encoding='utf-8')
+
+    if mode == "a" and file_name.exists() and file_name.stat().st_size > 0 and salvage(file_name, compression, level):
+        logger.warning(f"Recovered {file_name} up to its last complete line, it was left unfinished.")
+
+    if compression == "gzip":
+        return gzip.open(file_name, mode=mode + 't', compresslevel=9 if level is None else level, newline='', encoding='utf-8')
+
+    if compression == "zstd":
+        zstandard = import_zstandard()
+        raw = open(file_name, mode=mode + 'b')
+        if mode == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor(level=3 if level is None else level).stream_writer(raw, closefd=True)
+        return io.TextIOWrapper(stream, newline='', encoding='utf-8', write_through=True)
+
+    raise ValueError(f"Unknown compression {compression!r}")
@@ -0,0 +1,154 @@
+"""Contains the AIMD controller for adaptive request concurrency."""
+
+import asyncio
+from time import monotonic
+
+from util.log import Logger
+
+logger = Logger(__name__)
+
+class AdaptiveConcurrency:
+    """
+    Additive-increase, multiplicative-decrease limit on requests in flight.
+
+    The window grows by roughly `increase` for every window's worth of
+    successful requests, but only while demand actually fills it, so a quiet
+    period cannot inflate it into a burst later. It is cut by `decrease` on a rate-limit error or
+    when a request takes more than `latency_tolerance` times the running
+    latency baseline. Cuts are spaced by at least one baseline latency so a
+    single burst of errors only shrinks the window once.
+
+    Attributes
+    ----------
+    limit : float
+        the current concurrency limit
+    min_limit : int
+        the smallest window allowed
+    max_limit : int
+        the largest window allowed
+    increase : float
+        the additive increase per window of successes
+    decrease : float
+        the multiplicative decrease factor on overload
+    latency_tolerance : float
+        the latency multiple of the baseline that counts as a spike
+    in_flight : int
+        the number of requests currently holding a slot
+    peak : int
+        the most requests in flight since the last recorded success
+    baseline : float
+        the exponentially weighted average latency in seconds
+
+    Example
+    -------
+    ```python
+    from util.concurrency import AdaptiveConcurrency
+
+    concurrency = AdaptiveConcurrency(initial=4, max_limit=100)
+    async with concurrency:
+        ...
+    concurrency.record(latency)
+    ```
+    """
+    limit: float
+    min_limit: int = 1
+    max_limit: int = 256
+    increase: float = 1.0
+    decrease: float = 0.5
+    latency_tolerance: float = 2.0
+    in_flight: int = 0
+    peak: int = 0
+    baseline: float = None
+
+    def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: int = 256, increase: float = 1.0, decrease: float = 0.5, latency_tolerance: float = 2.0) -> None:
+        """
+        Initialize the controller.
+
+        Parameters
+        ----------
+        initial : int
+            the starting window
+        min_limit : int
+            the smallest window allowed
+        max_limit : int
+            the largest window allowed
+        increase : float
+            the additive increase per window of successes
+        decrease : float
+            the multiplicative decrease factor on overload
+        latency_tolerance : float
+            the latency multiple of the baseline that counts as a spike
+        """
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.peak = 0
+        self.baseline = None
+        self.last_decrease = 0.0
+        self.condition = asyncio.Condition()
+
+    @property
+    def window(self) -> int:
+        """
+        The current number of requests allowed in flight.
+        """
+        return max(self.min_limit, int(self.limit))
+
+    async def __aenter__(self) -> "AdaptiveConcurrency":
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.window)
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def record(self, latency: float) -> None:
+        """
+        Record a successful request and grow or shrink the window.
+
+        Parameters
+        ----------
+        latency : float
+            the request latency in seconds
+        """
+        if self.baseline is None:
+            self.baseline = latency
+
+        if latency > self.baseline * self.latency_tolerance:
+            self.backoff(f"latency spike {round(latency, 2)}s")
+        elif self.peak >= self.window:
+            # Only grow a window that was saturated
+            self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+        self.peak = self.in_flight
+
+        self.baseline = 0.9 * self.baseline + 0.1 * latency
+
+    def overload(self) -> None:
+        """
+        Record a rate-limit error and shrink the window.
+        """
+        self.backoff("rate limited")
+
+    def backoff(self, reason: str) -> None:
+        """
+        Cut the window multiplicatively, at most once per baseline latency.
+
+        Parameters
+        ----------
+        reason : str
+            the reason logged with the new window
+        """
+        now = monotonic()
+        if now - self.last_decrease < (self.baseline or 0.0):
+            return
+        self.last_decrease = now
+        self.limit = max(float(self.min_limit), self.limit * self.decrease)
+        logger.warning(f"Concurrency window cut to {self.window} ({reason}).")
@@ -0,0 +1,191 @@
+"""Contains helpers to find fenced code blocks in model responses."""
+
+import re
+from typing import List, Literal, Tuple
+
+FENCE = "```"
+
+# An opening fence with any language tag, the body, then a closing fence or the end of the text
+BLOCK_PATTERN = re.compile(r"```[ \t]*([^\s`]*)[^\n`]*\n(.*?)(```|\Z)", re.S)
+
+Fallback = Literal["raw", "empty"]
+
+class FenceDetector:
+    """
+    Incremental detector for the end of the first fenced code block.
+
+    Text is fed in as it streams; each call only scans the new text plus
+    the last two characters, so a fence split across deltas is still found
+    and the total work stays linear in the length of the response.
+
+    Attributes
+    ----------
+    text : str
+        the text received so far
+    start : int
+        the index just past the opening fence line, once seen
+    end : int
+        the index just past the closing fence, once seen
+
+    Example
+    -------
+    ```python
+    from util.fence import FenceDetector
+
+    detector = FenceDetector()
+    for delta in deltas:
+        if detector.feed(delta):
+            break
+    text = detector.text[:detector.end]
+    ```
+    """
+    text: str = ""
+    start: int = None
+    end: int = None
+
+    def __init__(self) -> None:
+        """
+        Initialize the detector.
+        """
+        self.text = ""
+        self.start = None
+        self.end = None
+        self.scanned = 0
+
+    @property
+    def closed(self) -> bool:
+        """
+        Whether the first fenced block has closed.
+        """
+        return self.end is not None
+
+    def feed(self, delta: str) -> bool:
+        """
+        Add streamed text and check whether the first block has closed.
+
+        Parameters
+        ----------
+        delta : str
+            the new text
+
+        Returns
+        -------
+        bool
+            whether the first fenced block has closed
+        """
+        # Keep every delta, the caller decides whether to cut at the fence
+        self.text += delta
+        if self.closed:
+            return True
+
+        # Find the opening fence and the end of its language tag line
+        if self.start is None:
+            opening = self.text.find(FENCE, max(0, self.scanned - 2))
+            if opening == -1:
+                self.scanned = len(self.text)
+                return False
+            newline = self.text.find("\n", opening + len(FENCE))
+            if newline == -1:
+                self.scanned = opening
+                return False
+            self.start = newline + 1
+            self.scanned = self.start
+
+        # Find the closing fence
+        closing = self.text.find(FENCE, max(self.start, self.scanned - 2))
+        if closing == -1:
+            self.scanned = len(self.text)
+            return False
+        self.end = closing + len(FENCE)
+        return True
+
+class Extraction:
+    """
+    Result of extracting code blocks from a response.
+
+    Attributes
+    ----------
+    code : str
+        the body of the first block, or the fallback if there is none
+    language : str
+        the language tag of the first block, empty if untagged
+    blocks : List[Tuple[str, str]]
+        the (language, body) of every block, in order
+    complete : bool
+        whether the first block has a closing fence
+    fallback : bool
+        whether no block was found and the fallback policy was applied
+    """
+    code: str
+    language: str = ""
+    blocks: List[Tuple[str, str]]
+    complete: bool = False
+    fallback: bool = False
+
+    def __init__(self, code: str, language: str = "", blocks: List[Tuple[str, str]] = None, complete: bool = False, fallback: bool = False) -> None:
+        """
+        Initialize the Extraction.
+
+        Parameters
+        ----------
+        code : str
+            the body of the first block, or the fallback if there is none
+        language : str
+            the language tag of the first block
+        blocks : List[Tuple[str, str]]
+            the (language, body) of every block
+        complete : bool
+            whether the first block has a closing fence
+        fallback : bool
+            whether the fallback policy was applied
+        """
+        self.code = code
+        self.language = language
+        self.blocks = blocks or []
+        self.complete = complete
+        self.fallback = fallback
+
+def extract_code(text: str, fallback: Fallback = "raw") -> Extraction:
+    """
+    Extract fenced code blocks from a response in a single pass.
+
+    Any language tag is accepted, and an unterminated last block runs to
+    the end of the text. When there is no fence at all, `fallback` decides
+    whether the code is the whole stripped response ("raw") or empty
+    ("empty"), so a malformed answer never raises.
+
+    Parameters
+    ----------
+    text : str
+        the response text, may be None
+    fallback : Fallback
+        the policy when the response has no fenced block
+
+    Returns
+    -------
+    Extraction
+        the extracted blocks
+
+    Example
+    -------
+    ```python
+    from util.fence import extract_code
+
+    extraction = extract_code(response)
+    if extraction.complete:
+        run(extraction.code)
+    ```
+    """
+    text = text or ""
+    blocks = []
+    complete = False
+    for match in BLOCK_PATTERN.finditer(text):
+        if not blocks:
+            complete = bool(match.group(3))
+        blocks.append((match.group(1), match.group(2)))
+
+    if not blocks:
+        return Extraction(text.strip() if fallback == "raw" else "", fallback=True)
+
+    language, code = blocks[0]
+    return Extraction(code, language=language, blocks=blocks, complete=complete)
@@ -0,0 +1,238 @@
+"""Contains the memory-mapped CSV reader with a persistent byte-offset record index."""
+
+import csv
+import io
+import mmap
+import os
+import re
+import struct
+from array import array
+from pathlib import Path
+from typing import Iterator, List
+
+from util.compress import detect_compression
+from util.log import Logger
+
+logger = Logger(__name__)
+
+# A quoted field, which may span lines and only opens at the start of a field, or a bare newline that ends a record;
+# the closing quote is optional so a quoted field cut off by the end of the scanned range still matches
+RECORD_END_PATTERN = re.compile(rb'(?<![^,\n])"[^"]*(?:""[^"]*)*(")?|(\n)')
+
+INDEX_MAGIC = b"CSVIDX2\0"
+INDEX_HEADER = struct.Struct("<8sQQQ")
+
+class CsvIndex:
+    """
+    Random access to the records of a CSV file through a memory map.
+
+    The start of every record is found in one pass over the mapped bytes,
+    skipping newlines inside quoted fields, so multiline prompts stay whole.
+    The offsets are saved next to the file and reused as long as the size
+    and modification time of the CSV match, so shards and resumed runs
+    seek straight to their rows instead of parsing from the top. Records
+    are only decoded when they are read.
+
+    Attributes
+    ----------
+    file_name : Path
+        the path of the CSV file
+    index_file : Path
+        the path of the saved offsets
+    offsets : array
+        the byte offset of every record, followed by the end of the file
+
+    Raises
+    ------
+    ValueError
+        if the file is compressed and cannot be memory-mapped
+
+    Example
+    -------
+    ```python
+    from util.index import CsvIndex
+
+    with CsvIndex(Path("attempts.csv")) as index:
+        header = index.row(0)
+        for row in index.rows(1000, 2000):
+            ...
+    ```
+    """
+    file_name: Path
+    index_file: Path
+    offsets: array
+
+    def __init__(self, file_name: Path, index_file: Path = None) -> None:
+        """
+        Map the file and load its index, building and saving it if stale.
+
+        Parameters
+        ----------
+        file_name : Path
+            the path of the CSV file
+        index_file : Path
+            the path of the saved offsets, defaults to the file name plus ".idx"
+        """
+        compression = detect_compression(file_name)
+        if compression:
+            raise ValueError(f"Cannot memory-map {compression} input {file_name}, decompress it first")
+
+        self.file_name = file_name
+        self.index_file = index_file or file_name.with_name(file_name.name + ".idx")
+        self.file = open(file_name, mode='rb')
+        stat = os.fstat(self.file.fileno())
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b""
+        self.offsets = self.load(stat)
+        if self.offsets is None:
+            self.offsets = self.build()
+            try:
+                self.save(stat)
+            except OSError as e:
+                logger.warning(f"Could not save index {self.index_file}: {e}")
+
+    def load(self, stat: os.stat_result) -> array:
+        """
+        Load the saved offsets if they match the current file.
+
+        Parameters
+        ----------
+        stat : os.stat_result
+            the status of the CSV file
+
+        Returns
+        -------
+        array
+            the offsets, or None if missing or stale
+        """
+        if not self.index_file.exists():
+            return None
+        with open(self.index_file, mode='rb') as file:
+            header = file.read(INDEX_HEADER.size)
+            if len(header) < INDEX_HEADER.size:
+                return None
+            magic, size, mtime, count = INDEX_HEADER.unpack(header)
+            if magic != INDEX_MAGIC or size != stat.st_size or mtime != stat.st_mtime_ns:
+                logger.info(f"Index {self.index_file} is stale, rebuilding.")
+                return None
+            offsets = array("Q")
+            offsets.frombytes(file.read(count * offsets.itemsize))
+        if len(offsets) != count:
+            return None
+        return offsets
+
+    def build(self) -> array:
+        """
+        Find the start of every record in one pass over the mapped bytes.
+
+        Returns
+        -------
+        array
+            the offsets, followed by the end of the file
+        """
+        offsets = array("Q", [0])
+        for match in RECORD_END_PATTERN.finditer(self.map):
+            if match.group(2):
+                offsets.append(match.end())
+        if offsets[-1] != len(self.map):
+            offsets.append(len(self.map))
+        return offsets
+
+    def save(self, stat: os.stat_result) -> None:
+        """
+        Save the offsets next to the file, replacing any stale index atomically.
+
+        Parameters
+        ----------
+        stat : os.stat_result
+            the status of the CSV file
+        """
+        temporary = self.index_file.with_name(self.index_file.name + ".tmp")
+        with open(temporary, mode='wb') as file:
+            file.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(self.offsets)))
+            file.write(self.offsets.tobytes())
+        os.replace(temporary, self.index_file)
+
+    def __len__(self) -> int:
+        """
+        The number of records, including the header.
+        """
+        return len(self.offsets) - 1
+
+    def offset(self, k: int) -> int:
+        """
+        Get the byte offset of a record.
+
+        Parameters
+        ----------
+        k : int
+            the record number, 0 for the header
+
+        Returns
+        -------
+        int
+            the offset of the first byte of the record
+        """
+        return self.offsets[k]
+
+    def row(self, k: int) -> List[str]:
+        """
+        Parse one record.
+
+        Parameters
+        ----------
+        k : int
+            the record number, 0 for the header
+
+        Returns
+        -------
+        List[str]
+            the fields of the record
+
+        Raises
+        ------
+        ValueError
+            if the indexed range does not hold exactly one record
+        """
+        text = self.map[self.offsets[k]:self.offsets[k + 1]].decode("utf-8")
+        records = list(csv.reader(io.StringIO(text, newline="")))
+        if len(records) != 1:
+            raise ValueError(f"Record {k} of {self.file_name} parsed as {len(records)} records, the index is misaligned")
+        return records[0]
+
+    def rows(self, start: int = 0, stop: int = None, chunk_size: int = 1024) -> Iterator[List[str]]:
+        """
+        Parse a range of records, decoding `chunk_size` records at a time.
+
+        Parameters
+        ----------
+        start : int
+            the first record
+        stop : int
+            the record to stop before, the end of the file if None
+        chunk_size : int
+            the number of records decoded at once
+
+        Returns
+        -------
+        Iterator[List[str]]
+            the fields of every record in the range
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        for first in range(start, stop, chunk_size):
+            last = min(first + chunk_size, stop)
+            text = self.map[self.offsets[first]:self.offsets[last]].decode("utf-8")
+            yield from csv.reader(io.StringIO(text, newline=""))
+
+    def close(self) -> None:
+        """
+        Unmap and close the file.
+        """
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self) -> "CsvIndex":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,205 @@
+"""Contains the parallel CSV reader that parses byte ranges in worker processes."""
+
+import csv
+import io
+import itertools
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+from util.compress import detect_compression
+from util.index import RECORD_END_PATTERN
+
+# Appended to a range, parses as a record of its own unless the range ends inside a quoted field, which it closes
+SENTINEL = '\uffff"\n'
+
+def looks_like_record_start(data: bytes, columns: int, records: int = 4) -> bool:
+    """
+    Check whether bytes plausibly start at a record boundary.
+
+    Parameters
+    ----------
+    data : bytes
+        a window of the file from the candidate offset
+    columns : int
+        the number of fields per record
+    records : int
+        the number of complete records that must have `columns` fields
+
+    Returns
+    -------
+    bool
+        whether every complete record in the window, up to `records`, has the right number of fields
+    """
+    # The last record read may be cut off by the end of the window
+    reader = csv.reader(io.StringIO(data.decode("utf-8", errors="replace"), newline=""))
+    parsed = list(itertools.islice(reader, records + 1))[:-1]
+    return bool(parsed) and all(len(record) == columns for record in parsed)
+
+def split_ranges(file_name: Path, chunk_bytes: int, window: int = 2**16, candidates: int = 64) -> Iterator[Tuple[int, int]]:
+    """
+    Cut a file into byte ranges of about `chunk_bytes`, each ending just after a newline.
+
+    Only a small window after each target is read. The split goes after
+    the first newline whose following records have as many fields as the
+    header, since a newline inside a quoted multiline field rarely is
+    followed by well-formed records. That is a guess, so `parse_range`
+    still validates every range.
+
+    Parameters
+    ----------
+    file_name : Path
+        the path of the CSV file
+    chunk_bytes : int
+        the target size of a range
+    window : int
+        the bytes read after a candidate newline to check it
+    candidates : int
+        the newlines checked after each target before taking the first
+
+    Returns
+    -------
+    Iterator[Tuple[int, int]]
+        the (begin, end) offsets of consecutive ranges covering the file
+    """
+    size = file_name.stat().st_size
+    if not size:
+        return
+    with open(file_name, mode='rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        header = data[:data.find(b"\n") + 1 or size]
+        columns = len(next(csv.reader(io.StringIO(header.decode("utf-8", errors="replace"), newline="")), []))
+        begin = 0
+        while begin < size:
+            end = first = data.find(b"\n", begin + chunk_bytes - 1) + 1 or size
+            for _ in range(candidates):
+                if end >= size or looks_like_record_start(data[end:end + window], columns):
+                    break
+                end = data.find(b"\n", end) + 1 or size
+            else:
+                end = first
+            yield begin, end
+            begin = end
+
+def parse_range(file_name: Path, begin: int, end: int) -> Tuple[List[List[str]], int]:
+    """
+    Parse the complete records in a byte range of a CSV file.
+
+    The range must start on a record boundary. It is parsed with a
+    sentinel record appended, which stays separate when the range ends on
+    a record boundary; otherwise the range is scanned for quoted fields
+    and only the records up to the last real boundary are parsed.
+
+    Parameters
+    ----------
+    file_name : Path
+        the path of the CSV file
+    begin : int
+        the offset of the first record
+    end : int
+        the offset the range was cut at
+
+    Returns
+    -------
+    Tuple[List[List[str]], int]
+        the fields of every complete record, and the offset just past the last of them
+    """
+    with open(file_name, mode='rb') as file:
+        file.seek(begin)
+        data = file.read(end - begin)
+        at_end = not file.read(1)
+
+    text = data.decode("utf-8")
+    if at_end:
+        return list(csv.reader(io.StringIO(text, newline=""))), end
+    records = list(csv.reader(io.StringIO(text + SENTINEL, newline="")))
+    if records and records[-1] == [SENTINEL[:-1]]:
+        return records[:-1], end
+
+    # The range ends inside a quoted field, so find the end of the last record, a newline outside any quoted field
+    boundary = 0
+    for match in RECORD_END_PATTERN.finditer(data):
+        if match.group(2):
+            boundary = match.end()
+    return list(csv.reader(io.StringIO(data[:boundary].decode("utf-8"), newline=""))), begin + boundary
+
+def parallel_chunks(file_name: Path, workers: int = None, chunk_bytes: int = 16 * 2**20, prefetch: int = None) -> Iterator[List[List[str]]]:
+    """
+    Parse a CSV file in a process pool, yielding the records chunk by chunk in file order.
+
+    The file is split near every `chunk_bytes`, and workers parse the
+    ranges in parallel while up to `prefetch` of them are in flight ahead
+    of the consumer. When a split turns out to fall inside a quoted
+    multiline field, the records up to the last real boundary are kept and
+    the rest is parsed again together with the next range, so records are
+    never cut and a bad split costs one range.
+
+    Parameters
+    ----------
+    file_name : Path
+        the path of the CSV file
+    workers : int
+        the number of worker processes, the CPU count if None
+    chunk_bytes : int
+        the target size of a chunk
+    prefetch : int
+        the number of chunks in flight, twice the workers if None
+
+    Returns
+    -------
+    Iterator[List[List[str]]]
+        the records of every chunk, including the header
+
+    Raises
+    ------
+    ValueError
+        if the file is compressed and cannot be split into byte ranges
+
+    Example
+    -------
+    ```python
+    from util.ingest import parallel_chunks
+
+    for chunk in parallel_chunks(Path("attempts.csv"), workers=8):
+        for row in chunk:
+            ...
+    ```
+    """
+    compression = detect_compression(file_name)
+    if compression:
+        raise ValueError(f"Cannot split {compression} input {file_name} into byte ranges, decompress it first")
+
+    workers = workers or os.cpu_count()
+    prefetch = prefetch or 2 * workers
+    ranges = split_ranges(file_name, chunk_bytes)
+    executor = ProcessPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        while True:
+            while len(pending) < prefetch:
+                following = next(ranges, None)
+                if following is None:
+                    break
+                pending.append((following, executor.submit(parse_range, file_name, *following)))
+            if not pending:
+                return
+
+            (begin, end), future = pending.popleft()
+            records, boundary = future.result()
+            if records:
+                yield records
+            if boundary == end:
+                continue
+
+            # The split fell inside a quoted field, so parse the rest again through the end of the next range
+            if not pending:
+                pending.append((next(ranges), None))
+            (_, end), following = pending.popleft()
+            if following:
+                following.cancel()
+            pending.appendleft(((boundary, end), executor.submit(parse_range, file_name, boundary, end)))
+    finally:
+        ranges.close()
+        executor.shutdown(cancel_futures=True)
@@ -0,0 +1,118 @@
+"""Contains the token-bucket rate limiter for pacing API calls."""
+
+import asyncio
+import threading
+from time import monotonic, sleep
+
+class RateLimiter:
+    """
+    Token-bucket rate limiter shared by sync and async callers.
+
+    Tokens are reserved up front, so the bucket may go into debt and each
+    caller simply sleeps until its reservation is paid off. No lock is held
+    while sleeping, which keeps waiters in FIFO order without serializing
+    them behind one another.
+
+    Attributes
+    ----------
+    rate : float
+        the number of tokens added per second
+    capacity : float
+        the maximum number of tokens the bucket can hold
+    tokens : float
+        the tokens currently available, negative when in debt
+
+    Example
+    -------
+    ```python
+    from util.limiter import RateLimiter
+
+    limiter = RateLimiter(5.0)
+    await limiter.acquire()
+    ```
+    """
+    rate: float
+    capacity: float
+    tokens: float
+
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        """
+        Initialize the rate limiter.
+
+        Parameters
+        ----------
+        rate : float
+            the number of tokens added per second
+        capacity : float
+            the maximum burst size, defaults to one second worth of tokens
+        """
+        if rate <= 0:
+            raise ValueError("Rate must be positive.")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """
+        Reserve tokens from the bucket.
+
+        Parameters
+        ----------
+        tokens : float
+            the number of tokens to take
+
+        Returns
+        -------
+        float
+            the number of seconds to wait before the tokens are available
+        """
+        with self.lock:
+            self._refill()
+            self.tokens -= tokens
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def adjust(self, tokens: float) -> None:
+        """
+        Return tokens to the bucket, or take more when negative.
+
+        Parameters
+        ----------
+        tokens : float
+            the number of tokens to give back
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        """
+        Wait asynchronously until the tokens are available.
+
+        Parameters
+        ----------
+        tokens : float
+            the number of tokens to take
+        """
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def wait(self, tokens: float = 1.0) -> None:
+        """
+        Block until the tokens are available.
+
+        Parameters
+        ----------
+        tokens : float
+            the number of tokens to take
+        """
+        delay = self.reserve(tokens)
+        if delay > 0:
+            sleep(delay)
@@ -0,0 +1,117 @@
+"""Contains the per-run latency metrics for completions."""
+
+from typing import Dict, List, Sequence
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Compute a percentile with the nearest-rank method.
+
+    Parameters
+    ----------
+    values : List[float]
+        the sorted values
+    q : float
+        the percentile, 0 to 100
+
+    Returns
+    -------
+    float
+        the percentile, or None if there are no values
+    """
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * q // 100))
+    return values[int(rank) - 1]
+
+class LatencyMetrics:
+    """
+    Latency profile of the completions run on one OpenAI instance.
+
+    Each request records its queueing delay before it was sent, its total
+    duration and its output speed; streamed requests also record the time
+    to first token, which separates server think time from generation.
+
+    Attributes
+    ----------
+    samples : Dict[str, List[float]]
+        the recorded values per metric
+
+    Example
+    -------
+    ```python
+    from util.metrics import LatencyMetrics
+
+    metrics = LatencyMetrics()
+    metrics.record(duration=2.1, queued=0.3, ttft=0.4, tokens=120)
+    logger.info(metrics.summary())
+    ```
+    """
+    samples: Dict[str, List[float]]
+
+    def __init__(self) -> None:
+        """
+        Initialize the metrics.
+        """
+        self.samples = {"queued": [], "ttft": [], "duration": [], "tokens_per_second": []}
+
+    def record(self, duration: float, queued: float = None, ttft: float = None, tokens: int = None) -> None:
+        """
+        Record one request.
+
+        Parameters
+        ----------
+        duration : float
+            the seconds from sending the request to the last token
+        queued : float
+            the seconds spent waiting on limiters before sending
+        ttft : float
+            the seconds from sending the request to the first token, if streamed
+        tokens : int
+            the completion tokens generated
+        """
+        self.samples["duration"].append(duration)
+        if queued is not None:
+            self.samples["queued"].append(queued)
+        if ttft is not None:
+            self.samples["ttft"].append(ttft)
+
+        # Generation speed excludes the time to first token when it is known
+        generating = duration - (ttft or 0.0)
+        if tokens and generating > 0:
+            self.samples["tokens_per_second"].append(tokens / generating)
+
+    def percentiles(self, qs: Sequence[float] = (50, 90, 99)) -> Dict[str, Dict[str, float]]:
+        """
+        Compute the percentiles of every metric.
+
+        Parameters
+        ----------
+        qs : Sequence[float]
+            the percentiles to compute
+
+        Returns
+        -------
+        Dict[str, Dict[str, float]]
+            the percentiles keyed by metric, then by "p50", "p90" and so on
+        """
+        result = {}
+        for name, values in self.samples.items():
+            values = sorted(values)
+            result[name] = {f"p{q:g}": percentile(values, q) for q in qs}
+        return result
+
+    def summary(self) -> str:
+        """
+        Format the percentiles for logging.
+
+        Returns
+        -------
+        str
+            one line per metric that has samples
+        """
+        lines = [f"{len(self.samples['duration'])} requests"]
+        for name, values in self.percentiles().items():
+            if not self.samples[name]:
+                continue
+            lines.append(f"{name}: " + " ".join(f"{q}={round(value, 2)}" for q, value in values.items()))
+        return "\n".join(lines)
@@ -0,0 +1,182 @@
+"""Contains the retry policy with exponential backoff and jitter."""
+
+import random
+import re
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from time import monotonic
+from typing import Mapping
+
+# Durations like "20ms", "1s", "6m0s" or "1h2m3.5s" used by x-ratelimit-reset-*
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+def parse_duration(value: str) -> float:
+    """
+    Parse a rate-limit reset duration.
+
+    Parameters
+    ----------
+    value : str
+        the duration, e.g. "6m0s", or a plain number of seconds
+
+    Returns
+    -------
+    float
+        the duration in seconds, or None if it cannot be parsed
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+def retry_after(headers: Mapping[str, str]) -> float:
+    """
+    Read the server's requested wait from response headers.
+
+    Parameters
+    ----------
+    headers : Mapping[str, str]
+        the response headers
+
+    Returns
+    -------
+    float
+        the seconds to wait, or None if the headers give no hint
+    """
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+
+    resets = [parse_duration(headers[name]) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens") if headers.get(name)]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, a cap and a total deadline.
+
+    Attributes
+    ----------
+    max_attempts : int
+        the maximum number of attempts per request
+    base : float
+        the backoff of the first retry in seconds
+    cap : float
+        the largest backoff in seconds
+    deadline : float
+        the total seconds allowed per request, including waits
+
+    Example
+    -------
+    ```python
+    from util.retry import RetryPolicy
+
+    policy = RetryPolicy(max_attempts=8, deadline=300)
+    delay = policy.delay(attempt, headers)
+    ```
+    """
+    max_attempts: int = 10
+    base: float = 1.0
+    cap: float = 60.0
+    deadline: float = 600.0
+
+    def __init__(self, max_attempts: int = 10, base: float = 1.0, cap: float = 60.0, deadline: float = 600.0) -> None:
+        """
+        Initialize the retry policy.
+
+        Parameters
+        ----------
+        max_attempts : int
+            the maximum number of attempts per request
+        base : float
+            the backoff of the first retry in seconds
+        cap : float
+            the largest backoff in seconds
+        deadline : float
+            the total seconds allowed per request, including waits
+        """
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+
+    def delay(self, attempt: int, headers: Mapping[str, str] = None) -> float:
+        """
+        Compute the wait before the next attempt.
+
+        The server's Retry-After or rate-limit reset hint is honoured when
+        present, with a little jitter so waiters do not wake together.
+
+        Parameters
+        ----------
+        attempt : int
+            the zero-based number of the attempt that just failed
+        headers : Mapping[str, str]
+            the headers of the failed response, if any
+
+        Returns
+        -------
+        float
+            the seconds to wait
+        """
+        hint = retry_after(headers)
+        if hint is not None:
+            return hint + random.uniform(0, self.base)
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def remaining(self, started: float) -> float:
+        """
+        Get the time left before the deadline.
+
+        Parameters
+        ----------
+        started : float
+            the `time.monotonic()` at which the request started
+
+        Returns
+        -------
+        float
+            the seconds left, never negative
+        """
+        return max(0.0, self.deadline - (monotonic() - started))
+
+    def should_retry(self, attempt: int, started: float, delay: float) -> bool:
+        """
+        Check whether another attempt fits the attempt and time budgets.
+
+        Parameters
+        ----------
+        attempt : int
+            the zero-based number of the attempt that just failed
+        started : float
+            the `time.monotonic()` at which the request started
+        delay : float
+            the wait before the next attempt
+
+        Returns
+        -------
+        bool
+            whether to retry
+        """
+        return attempt + 1 < self.max_attempts and delay < self.remaining(started)
@@ -0,0 +1,448 @@
+"""Contains the streaming output sinks for sampled results."""
+
+import csv
+import json
+import os
+from pathlib import Path
+from typing import Callable, List, Literal, Sequence
+
+from util.compress import Compression, open_text
+
+ColumnarFormat = Literal["parquet", "arrow"]
+
+class CsvSink:
+    """
+    Streaming CSV writer that appends rows as they complete.
+
+    Rows are buffered and written in batches of `flush_every`, so memory is
+    bounded by the buffer and the work in flight rather than by the size of
+    the dataset, and a crash loses at most one unflushed batch.
+
+    Attributes
+    ----------
+    file_name : Path
+        the path of the output file
+    flush_every : int
+        the number of buffered rows that triggers a flush
+    rows_written : int
+        the number of rows flushed so far, excluding the header
+    sync : bool
+        whether each flush is synced to disk
+    on_flush : Callable[[], None]
+        called after every flush, e.g. to advance a checkpoint
+    compression : Compression
+        the streaming compression of the file, plain text if None
+
+    Example
+    -------
+    ```python
+    from util.sink import CsvSink
+
+    with CsvSink(Path("out.csv"), header=["a", "b"]) as sink:
+        sink.write([[1, 2], [3, 4]])
+    ```
+    """
+    file_name: Path
+    flush_every: int = 100
+    rows_written: int = 0
+    sync: bool = False
+    on_flush: Callable[[], None] = None
+    compression: Compression = None
+
+    def __init__(self, file_name: Path, header: List[str], flush_every: int = 100, append: bool = False, sync: bool = False, on_flush: Callable[[], None] = None, compression: Compression = None, level: int = None) -> None:
+        """
+        Open the sink and write the header, unless appending to an existing file.
+
+        Parameters
+        ----------
+        file_name : Path
+            the path of the output file
+        header : List[str]
+            the column names
+        flush_every : int
+            the number of buffered rows that triggers a flush
+        append : bool
+            whether to append to the file instead of replacing it
+        sync : bool
+            whether each flush is synced to disk
+        on_flush : Callable[[], None]
+            called after every flush
+        compression : Compression
+            the streaming compression of the file, plain text if None
+        level : int
+            the compression level, the library default if None
+        """
+        self.file_name = file_name
+        self.flush_every = flush_every
+        self.rows_written = 0
+        self.sync = sync
+        self.on_flush = on_flush
+        self.compression = compression
+        self.buffer = []
+        
+        append = append and file_name.exists() and file_name.stat().st_size > 0
+        self.file = open_text(file_name, 'a' if append else 'w', compression=compression, level=level)
+        self.writer = csv.writer(self.file)
+        if not append:
+            self.writer.writerow(header)
+
+    def write(self, rows: List[list]) -> None:
+        """
+        Buffer rows and flush once the buffer is full.
+
+        Parameters
+        ----------
+        rows : List[list]
+            the rows to write
+        """
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered rows and flush them to the operating system.
+        """
+        if self.buffer:
+            self.writer.writerows(self.buffer)
+            self.rows_written += len(self.buffer)
+            self.buffer = []
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        if self.on_flush:
+            self.on_flush()
+
+    def close(self) -> None:
+        """
+        Flush the remaining rows and close the file.
+        """
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self) -> "CsvSink":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+class JsonlSink:
+    """
+    Streaming JSON Lines writer for structured records.
+
+    Records are buffered and flushed like in CsvSink, one compact JSON
+    object per line, so a sidecar of metadata can be written next to the
+    main output and read back line by line.
+
+    Attributes
+    ----------
+    file_name : Path
+        the path of the output file
+    flush_every : int
+        the number of buffered records that triggers a flush
+    rows_written : int
+        the number of records flushed so far
+    sync : bool
+        whether each flush is synced to disk
+    on_flush : Callable[[], None]
+        called after every flush, e.g. to advance a checkpoint
+    compression : Compression
+        the streaming compression of the file, plain text if None
+
+    Example
+    -------
+    ```python
+    from util.sink import JsonlSink
+
+    with JsonlSink(Path("metadata.jsonl")) as sink:
+        sink.write([{"row_id": 1, "trial": 1, "id": "chatcmpl-123"}])
+    ```
+    """
+    file_name: Path
+    flush_every: int = 100
+    rows_written: int = 0
+    sync: bool = False
+    on_flush: Callable[[], None] = None
+    compression: Compression = None
+
+    def __init__(self, file_name: Path, flush_every: int = 100, append: bool = False, sync: bool = False, on_flush: Callable[[], None] = None, compression: Compression = None, level: int = None) -> None:
+        """
+        Open the sink.
+
+        Parameters
+        ----------
+        file_name : Path
+            the path of the output file
+        flush_every : int
+            the number of buffered records that triggers a flush
+        append : bool
+            whether to append to the file instead of replacing it
+        sync : bool
+            whether each flush is synced to disk
+        on_flush : Callable[[], None]
+            called after every flush
+        compression : Compression
+            the streaming compression of the file, plain text if None
+        level : int
+            the compression level, the library default if None
+        """
+        self.file_name = file_name
+        self.flush_every = flush_every
+        self.rows_written = 0
+        self.sync = sync
+        self.on_flush = on_flush
+        self.compression = compression
+        self.buffer = []
+        self.file = open_text(file_name, 'a' if append else 'w', compression=compression, level=level)
+
+    def write(self, records: List[dict]) -> None:
+        """
+        Buffer records and flush once the buffer is full.
+
+        Parameters
+        ----------
+        records : List[dict]
+            the JSON serializable records to write
+        """
+        self.buffer.extend(records)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered records and flush them to the operating system.
+        """
+        if self.buffer:
+            self.file.write("".join(json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n" for record in self.buffer))
+            self.rows_written += len(self.buffer)
+            self.buffer = []
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        if self.on_flush:
+            self.on_flush()
+
+    def close(self) -> None:
+        """
+        Flush the remaining records and close the file.
+        """
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self) -> "JsonlSink":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+class ArrowSink:
+    """
+    Streaming columnar writer for Parquet row groups or Arrow IPC batches.
+
+    Rows are buffered like in CsvSink and every flush becomes one Parquet
+    row group or one Arrow record batch. Columns with many repeated values,
+    such as the prompt, are dictionary encoded, so files stay small and
+    pandas or DuckDB scan them without re-parsing text. Arrow output uses
+    the IPC stream format, which tolerates a new dictionary per batch and
+    stays readable up to the last complete batch if the run crashes.
+
+    pyarrow is an optional dependency and is only imported when a sink is
+    opened.
+
+    Attributes
+    ----------
+    file_name : Path
+        the path of the output file
+    format : ColumnarFormat
+        either "parquet" or "arrow"
+    flush_every : int
+        the number of buffered rows that triggers a flush
+    rows_written : int
+        the number of rows flushed so far
+    sync : bool
+        whether each flush is synced to disk
+    on_flush : Callable[[], None]
+        called after every flush, e.g. to advance a checkpoint
+
+    Raises
+    ------
+    ImportError
+        if pyarrow is not installed
+    ValueError
+        if asked to append to an existing file, which neither format supports
+
+    Example
+    -------
+    ```python
+    from util.sink import ArrowSink
+
+    with ArrowSink(Path("out.parquet"), header=["prompt", "row_id"], integer_columns=["row_id"]) as sink:
+        sink.write([["a", 1], ["a", 2]])
+    ```
+    """
+    file_name: Path
+    format: ColumnarFormat = "parquet"
+    flush_every: int = 100
+    rows_written: int = 0
+    sync: bool = False
+    on_flush: Callable[[], None] = None
+
+    def __init__(self, file_name: Path, header: List[str], format: ColumnarFormat = "parquet", flush_every: int = 100, append: bool = False, sync: bool = False, on_flush: Callable[[], None] = None, dictionary_columns: Sequence[str] = (), integer_columns: Sequence[str] = ()) -> None:
+        """
+        Open the sink.
+
+        Parameters
+        ----------
+        file_name : Path
+            the path of the output file
+        header : List[str]
+            the column names
+        format : ColumnarFormat
+            either "parquet" or "arrow"
+        flush_every : int
+            the number of buffered rows that triggers a flush
+        append : bool
+            whether resuming into an existing file was requested
+        sync : bool
+            whether each flush is synced to disk
+        on_flush : Callable[[], None]
+            called after every flush
+        dictionary_columns : Sequence[str]
+            the string columns to dictionary encode
+        integer_columns : Sequence[str]
+            the columns stored as 64-bit integers, every other column is a string
+        """
+        try:
+            import pyarrow
+        except ImportError as e:
+            raise ImportError(f"{format} output requires pyarrow, install it with `pip install pyarrow`") from e
+        if append and file_name.exists() and file_name.stat().st_size > 0:
+            raise ValueError(f"Cannot append to {format} output {file_name}, resume is only supported for CSV output")
+
+        self.pa = pyarrow
+        self.file_name = file_name
+        self.format = format
+        self.flush_every = flush_every
+        self.rows_written = 0
+        self.sync = sync
+        self.on_flush = on_flush
+        self.buffer = []
+        self.header = header
+        self.dictionary_columns = set(dictionary_columns)
+        self.integer_columns = set(integer_columns)
+
+        # Build the schema, dictionary columns keep their encoding through both formats
+        fields = []
+        for name in header:
+            if name in self.integer_columns:
+                fields.append(pyarrow.field(name, pyarrow.int64()))
+            elif name in self.dictionary_columns:
+                fields.append(pyarrow.field(name, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())))
+            else:
+                fields.append(pyarrow.field(name, pyarrow.string()))
+        self.schema = pyarrow.schema(fields)
+
+        self.file = open(file_name, mode='wb')
+        if format == "parquet":
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(self.file, self.schema, use_dictionary=sorted(self.dictionary_columns), compression="zstd")
+        elif format == "arrow":
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_stream(self.file, self.schema)
+        else:
+            self.file.close()
+            raise ValueError(f"Unknown columnar format {format!r}")
+
+    def write(self, rows: List[list]) -> None:
+        """
+        Buffer rows and flush once the buffer is full.
+
+        Parameters
+        ----------
+        rows : List[list]
+            the rows to write, in header order
+        """
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered rows as one row group or record batch.
+        """
+        if self.buffer:
+            arrays = []
+            for k, name in enumerate(self.header):
+                values = [row[k] for row in self.buffer]
+                if name in self.integer_columns:
+                    arrays.append(self.pa.array(values, type=self.pa.int64()))
+                    continue
+                array = self.pa.array([None if value is None else str(value) for value in values], type=self.pa.string())
+                arrays.append(array.dictionary_encode() if name in self.dictionary_columns else array)
+            batch = self.pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+            if self.format == "parquet":
+                self.writer.write_table(self.pa.Table.from_batches([batch]))
+            else:
+                self.writer.write_batch(batch)
+            self.rows_written += len(self.buffer)
+            self.buffer = []
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        if self.on_flush:
+            self.on_flush()
+
+    def close(self) -> None:
+        """
+        Flush the remaining rows, write the footer and close the file.
+        """
+        if not self.file.closed:
+            self.flush()
+            self.writer.close()
+            self.file.close()
+
+    def __enter__(self) -> "ArrowSink":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def merge_arrow_files(file_names: List[Path], output_file: Path, format: ColumnarFormat = "parquet") -> None:
+    """
+    Concatenate columnar files with the same schema, batch by batch.
+
+    Parameters
+    ----------
+    file_names : List[Path]
+        the files to merge, in order
+    output_file : Path
+        the path of the merged file
+    format : ColumnarFormat
+        either "parquet" or "arrow"
+    """
+    try:
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError(f"{format} output requires pyarrow, install it with `pip install pyarrow`") from e
+
+    writer = None
+    with open(output_file, mode='wb') as output:
+        for file_name in file_names:
+            if format == "parquet":
+                reader = pyarrow.parquet.ParquetFile(file_name)
+                if writer is None:
+                    dictionary_columns = [field.name for field in reader.schema_arrow if pyarrow.types.is_dictionary(field.type)]
+                    writer = pyarrow.parquet.ParquetWriter(output, reader.schema_arrow, use_dictionary=dictionary_columns, compression="zstd")
+                for k in range(reader.num_row_groups):
+                    writer.write_table(reader.read_row_group(k))
+            else:
+                with pyarrow.ipc.open_stream(file_name) as reader:
+                    if writer is None:
+                        writer = pyarrow.ipc.new_stream(output, reader.schema)
+                    for batch in reader:
+                        writer.write_batch(batch)
+        if writer is not None:
+            writer.close()
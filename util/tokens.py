@@ -0,0 +1,48 @@
+"""Contains functions to estimate the token count of a request."""
+
+from typing import List
+
+# Rough averages for English text and code with the GPT-4 tokenizers
+CHARS_PER_TOKEN = 4
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_IMAGE = 85
+
+def estimate_tokens(messages: List[dict]) -> int:
+    """
+    Estimate the prompt tokens of messages in OpenAI API format.
+
+    The estimate is deliberately cheap and slightly pessimistic, it is only
+    used for admission control and corrected once the real usage is known.
+
+    Parameters
+    ----------
+    messages : List[dict]
+        the messages returned by `to_openai()`
+
+    Returns
+    -------
+    int
+        the estimated number of prompt tokens
+
+    Example
+    -------
+    ```python
+    from util.tokens import estimate_tokens
+
+    tokens = estimate_tokens([UserMessage("Hello").to_openai()])
+    ```
+    """
+    chars = 0
+    images = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                chars += len(part.get("text", ""))
+            else:
+                images += 1
+
+    return -(-chars // CHARS_PER_TOKEN) + TOKENS_PER_MESSAGE * len(messages) + TOKENS_PER_IMAGE * images